@@ -1,21 +1,55 @@
-from fastapi import FastAPI, HTTPException, Depends, File, UploadFile, Form
+from fastapi import FastAPI, HTTPException, Depends, File, UploadFile, Form, Request, BackgroundTasks
+from fastapi.responses import FileResponse, StreamingResponse, RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.staticfiles import StaticFiles
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
 from typing import List, Optional
 import pymongo
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 import bcrypt
 import jwt
 import os
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 import uuid
+import sys
+import zlib
 import json
+from urllib.parse import quote
+import base64
+import csv
+import io
 import shutil
+import gzip
+import tempfile
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+import zipfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import PyPDF2
+import numpy as np
 import random
 import time
+import math
+import asyncio
+import threading
+import logging
+import bisect
+import ipaddress
+import re
+import heapq
+from collections import defaultdict, OrderedDict
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
@@ -36,10 +70,230 @@ users_collection = db['users']
 notes_collection = db['notes']
 payments_collection = db['payments']
 withdrawals_collection = db['withdrawals']
+notes_archive_collection = db['notes_archive']
+note_signatures_collection = db['note_signatures']
+note_terms_collection = db['note_terms']
+
+# File storage
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'local')
+S3_BUCKET = os.environ.get('S3_BUCKET', 'student-platform-notes')
+S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')  # e.g. a local MinIO stand-in
+S3_CACHE_DIR = os.environ.get('S3_CACHE_DIR', '/tmp/note_cache')
+S3_CACHE_MAX_BYTES = int(os.environ.get('S3_CACHE_MAX_BYTES', str(2 * 1024 ** 3)))
+S3_PRESIGN_SECONDS = 300
+S3_CACHE_PIN_SECONDS = 60  # A cache path handed out is kept at least this long so the caller can open it
+
+def content_disposition(filename: str) -> str:
+    """Attachment header for any file name; headers are latin-1, so others go as RFC 5987 UTF-8"""
+    quoted = quote(filename, safe="")
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
+def storage_path(root: str, key: str) -> str:
+    """Path of key under root, refusing keys that resolve outside it"""
+    root = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(root, key))
+    if os.path.commonpath([root, path]) != root:
+        raise ValueError(f"Storage key escapes {root}: {key!r}")
+    return path
+
+def upload_filename(name: Optional[str]) -> Optional[str]:
+    """A client-supplied file name reduced to its last component, or None if nothing usable is left"""
+    name = os.path.basename((name or "").replace("\\", "/"))
+    if name in ("", ".", "..") or "\x00" in name:
+        return None
+    return name
+
+class LocalStorage:
+    """Note files on this node's disk"""
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def local_path(self, key: str) -> str:
+        return storage_path(self.root, key)
+
+    def location(self, key: str) -> str:
+        return self.local_path(key)
+
+    def save(self, key: str, source):
+        path = self.local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as buffer:
+            shutil.copyfileobj(source, buffer)
+
+    def open(self, key: str):
+        return open(self.local_path(key), "rb")
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.local_path(key))
+
+    def delete(self, key: str):
+        if self.exists(key):
+            os.remove(self.local_path(key))
+
+    def download_response(self, key: str, download_name: str):
+        return FileResponse(
+            self.local_path(key),
+            media_type="application/pdf",
+            headers={"Content-Disposition": content_disposition(download_name)}
+        )
+
+class CachedFileReader(io.BufferedReader):
+    """A cache file opened for reading, reporting back when it is closed"""
+
+    def __init__(self, path: str, on_close):
+        super().__init__(io.FileIO(path, "rb"))
+        self._on_close = on_close
+
+    def close(self):
+        if not self.closed:
+            try:
+                super().close()
+            finally:
+                self._on_close()
+
+class S3Storage:
+    """Note files in an S3-compatible bucket, with a local read-through cache"""
+
+    def __init__(self, bucket: str, prefix: str, endpoint_url: Optional[str], cache_dir: str, cache_max_bytes: int = S3_CACHE_MAX_BYTES):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.cache_dir = os.path.join(cache_dir, prefix)
+        self.cache_max_bytes = cache_max_bytes
+        self.s3 = boto3.client("s3", endpoint_url=endpoint_url)
+        # Large files go up and down as parallel multipart transfers
+        self.transfer_config = TransferConfig(multipart_threshold=8 * 1024 ** 2, multipart_chunksize=8 * 1024 ** 2, max_concurrency=8)
+        self.cache_entries = OrderedDict()  # key -> (size, last used), least recently used first
+        self.cache_bytes = 0
+        self.readers = defaultdict(int)  # key -> open CachedFileReaders
+        self._cache_lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._load_cache()
+
+    def _load_cache(self):
+        """Adopt files cached by an earlier run, oldest first"""
+        files = []
+        for directory, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith(".part"):
+                    continue  # Another worker may still be downloading it
+                path = os.path.join(directory, name)
+                stat = os.stat(path)
+                files.append((stat.st_mtime, os.path.relpath(path, self.cache_dir), stat.st_size))
+        for _, key, size in sorted(files):
+            self.cache_entries[key] = (size, float("-inf"))
+            self.cache_bytes += size
+
+    def _cached(self, key: str, size: int):
+        """Record a file entering the cache as just used, then make room for it"""
+        with self._cache_lock:
+            old_size, _ = self.cache_entries.pop(key, (0, 0.0))
+            self.cache_entries[key] = (size, time.monotonic())
+            self.cache_bytes += size - old_size
+            self._evict()
+
+    def _evict(self):
+        """Drop least recently used cache files until the cache fits its budget"""
+        # Skip files being read, and paths handed out moments ago that a caller may be about to open
+        pinned_after = time.monotonic() - S3_CACHE_PIN_SECONDS
+        for key, (size, last_used) in list(self.cache_entries.items()):
+            if self.cache_bytes <= self.cache_max_bytes:
+                break
+            if self.readers.get(key) or last_used > pinned_after:
+                continue
+            try:
+                os.remove(storage_path(self.cache_dir, key))
+            except FileNotFoundError:
+                pass
+            del self.cache_entries[key]
+            self.cache_bytes -= size
+
+    def location(self, key: str) -> str:
+        return f"s3://{self.bucket}/{self.prefix}{key}"
+
+    def local_path(self, key: str) -> str:
+        """Path of a cached local copy, fetched from the bucket on a miss"""
+        path = storage_path(self.cache_dir, key)
+        if os.path.exists(path):
+            with self._cache_lock:
+                if key in self.cache_entries:
+                    self.cache_entries[key] = (self.cache_entries[key][0], time.monotonic())
+                    self.cache_entries.move_to_end(key)
+                    return path
+            # Cached by another worker sharing the directory
+            self._cached(key, os.path.getsize(path))
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial = f"{path}.{uuid.uuid4()}.part"
+        self.s3.download_file(self.bucket, self.prefix + key, partial, Config=self.transfer_config)
+        os.replace(partial, path)
+        self._cached(key, os.path.getsize(path))
+        return path
+
+    def save(self, key: str, source):
+        # Keep the upload in the cache too, since it is usually read right away
+        path = storage_path(self.cache_dir, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as buffer:
+            shutil.copyfileobj(source, buffer)
+        self.s3.upload_file(path, self.bucket, self.prefix + key, Config=self.transfer_config)
+        self._cached(key, os.path.getsize(path))
 
-# Create uploads directory
-os.makedirs('/app/uploads', exist_ok=True)
-app.mount("/uploads", StaticFiles(directory="/app/uploads"), name="uploads")
+    def open(self, key: str):
+        with self._cache_lock:
+            self.readers[key] += 1
+        try:
+            return CachedFileReader(self.local_path(key), lambda: self._release(key))
+        except BaseException:
+            self._release(key)
+            raise
+
+    def _release(self, key: str):
+        with self._cache_lock:
+            self.readers[key] -= 1
+            if not self.readers[key]:
+                del self.readers[key]
+
+    def exists(self, key: str) -> bool:
+        try:
+            self.s3.head_object(Bucket=self.bucket, Key=self.prefix + key)
+            return True
+        except ClientError:
+            return False
+
+    def delete(self, key: str):
+        self.s3.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+        path = storage_path(self.cache_dir, key)
+        with self._cache_lock:
+            size, _ = self.cache_entries.pop(key, (0, 0.0))
+            self.cache_bytes -= size
+        if os.path.exists(path):
+            os.remove(path)
+
+    def download_response(self, key: str, download_name: str):
+        # Let the client fetch the file straight from the bucket
+        url = self.s3.generate_presigned_url(
+            "get_object",
+            Params={
+                "Bucket": self.bucket,
+                "Key": self.prefix + key,
+                "ResponseContentType": "application/pdf",
+                "ResponseContentDisposition": content_disposition(download_name)
+            },
+            ExpiresIn=S3_PRESIGN_SECONDS
+        )
+        return RedirectResponse(url, status_code=307)
+
+if STORAGE_BACKEND == "s3":
+    file_storage = S3Storage(S3_BUCKET, "notes/", S3_ENDPOINT_URL, S3_CACHE_DIR)
+    cold_storage = S3Storage(S3_BUCKET, "cold/", S3_ENDPOINT_URL, S3_CACHE_DIR)
+else:
+    file_storage = LocalStorage('/app/uploads')
+    cold_storage = LocalStorage('/app/cold_storage')
+    app.mount("/uploads", StaticFiles(directory="/app/uploads"), name="uploads")
 
 # JWT settings
 SECRET_KEY = "your-secret-key-here"
@@ -48,6 +302,17 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 # Security
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
+
+# Rate limiting (set RATE_LIMIT_REDIS_URL to share buckets between workers)
+RATE_LIMIT_REDIS_URL = os.environ.get('RATE_LIMIT_REDIS_URL')
+rate_limit_redis = redis.Redis.from_url(RATE_LIMIT_REDIS_URL) if redis and RATE_LIMIT_REDIS_URL else None
+# Peers whose X-Forwarded-For we believe; set TRUSTED_PROXIES to the ingress range, e.g. 10.0.0.0/8
+TRUSTED_PROXIES = [
+    ipaddress.ip_network(network.strip())
+    for network in os.environ.get('TRUSTED_PROXIES', '127.0.0.1/32,::1/128').split(',')
+    if network.strip()
+]
 
 # Models
 class UserRegister(BaseModel):
@@ -86,6 +351,10 @@ class NoteAccess(BaseModel):
     note_id: str
     payment_method: str = "paypal"
 
+class CartCheckout(BaseModel):
+    note_ids: List[str]
+    payment_method: str = "paypal"
+
 class NoteComment(BaseModel):
     note_id: str
     comment: str
@@ -96,6 +365,21 @@ class WithdrawalRequest(BaseModel):
     payment_method: str = "generic"
 
 # Helper functions
+transactions_supported = True
+
+def run_transaction(callback):
+    """Run callback(session) in a transaction, or without one on a standalone server"""
+    global transactions_supported
+    if transactions_supported:
+        try:
+            with client.start_session() as session:
+                return session.with_transaction(callback)
+        except pymongo.errors.OperationFailure as e:
+            if e.code != 20:  # IllegalOperation: transactions need a replica set
+                raise
+            transactions_supported = False
+    return callback(None)
+
 def hash_password(password: str) -> str:
     return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
 
@@ -110,7 +394,9 @@ def create_access_token(data: dict):
     return encoded_jwt
 
 def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
-    token = credentials.credentials
+    return user_from_token(credentials.credentials)
+
+def user_from_token(token: str) -> dict:
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
@@ -123,6 +409,209 @@ def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(securit
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Ogiltiga autentiseringsuppgifter")
 
+def check_note_access(note: dict, user: dict) -> bool:
+    """Whether a user may read a note's file, raising 404 for deleted notes they never bought"""
+    is_owner = note["uploader_email"] == user["email"]
+    has_purchased = note["id"] in user.get("purchased_notes", [])
+    # If note is deleted, only allow access to owner and purchasers
+    if note.get("is_deleted", False) and not (is_owner or has_purchased):
+        raise HTTPException(status_code=404, detail="Anteckning hittades inte")
+    return is_owner or has_purchased or note["price"] == 0.0
+
+# Event stream
+EVENT_QUEUE_SIZE = 100
+EVENT_HEARTBEAT_SECONDS = 15
+
+class EventHub:
+    """In-process fan-out of per-user events to their open event streams"""
+
+    def __init__(self):
+        self.subscribers = defaultdict(set)  # email -> one bounded queue per open stream
+        self.loop = None
+        self._loop_thread = None
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        self.loop = loop
+        self._loop_thread = threading.get_ident()
+
+    def subscribe(self, email: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=EVENT_QUEUE_SIZE)
+        self.subscribers[email].add(queue)
+        return queue
+
+    def unsubscribe(self, email: str, queue: asyncio.Queue):
+        queues = self.subscribers.get(email)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.subscribers[email]
+
+    def publish(self, email: str, event: str, data: dict):
+        """Send an event to every open stream of a user; safe to call from worker threads"""
+        if self.loop is None or email not in self.subscribers:
+            return
+        message = f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+        if threading.get_ident() == self._loop_thread:
+            self._deliver(email, message)
+        else:
+            self.loop.call_soon_threadsafe(self._deliver, email, message)
+
+    def _deliver(self, email: str, message: str):
+        for queue in self.subscribers.get(email, ()):
+            if queue.full():
+                queue.get_nowait()  # Slow clients lose their oldest events instead of growing memory
+            queue.put_nowait(message)
+
+event_hub = EventHub()
+
+@app.on_event("startup")
+async def bind_event_hub():
+    event_hub.bind(asyncio.get_running_loop())
+
+# Admission control
+class RouteLimiter:
+    """Per-route concurrency limit with a bounded wait queue"""
+
+    def __init__(self, max_concurrent: int, max_queue: int, queue_timeout: float):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.waiting = 0
+        self._semaphore = None
+
+    def _reject(self):
+        raise HTTPException(
+            status_code=503,
+            detail="Servern är överbelastad, försök igen senare",
+            headers={"Retry-After": str(math.ceil(self.queue_timeout))}
+        )
+
+    async def __call__(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        if self._semaphore.locked() and self.waiting >= self.max_queue:
+            self._reject()
+
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._reject()
+        finally:
+            self.waiting -= 1
+
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+class TokenBucket:
+    """Per-key token bucket, kept in-process or in Redis when configured"""
+
+    REDIS_SCRIPT = """
+    local rate = tonumber(ARGV[1])
+    local capacity = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / rate
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+    return tostring(wait)
+    """
+
+    def __init__(self, name: str, per_minute: float, burst: int):
+        self.name = name
+        self.rate = per_minute / 60.0
+        self.capacity = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._script = rate_limit_redis.register_script(self.REDIS_SCRIPT) if rate_limit_redis else None
+
+    def take(self, key: str) -> float:
+        """Consume one token for key, returning 0 or the seconds until one is available"""
+        if self._script is not None:
+            try:
+                return float(self._script(
+                    keys=[f"ratelimit:{self.name}:{key}"],
+                    args=[self.rate, self.capacity, time.time()]
+                ))
+            except redis.RedisError:
+                pass  # Fall back to the in-process bucket if Redis is unavailable
+
+        now = time.monotonic()
+        with self._lock:
+            if len(self._buckets) > 100000:
+                self._prune(now)
+            tokens, updated = self._buckets.get(key, (self.capacity, now))
+            tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                return 0.0
+            self._buckets[key] = (tokens, now)
+            return (1 - tokens) / self.rate
+
+    def _prune(self, now: float):
+        """Drop buckets that have refilled completely"""
+        self._buckets = {
+            key: (tokens, updated) for key, (tokens, updated) in self._buckets.items()
+            if tokens + (now - updated) * self.rate < self.capacity
+        }
+
+    def enforce(self, key: str):
+        wait = self.take(key)
+        if wait > 0:
+            raise HTTPException(
+                status_code=429,
+                detail="För många förfrågningar, försök igen senare",
+                headers={"Retry-After": str(math.ceil(wait))}
+            )
+
+def rate_limit_user(bucket: TokenBucket):
+    async def dependency(current_user: dict = Depends(get_current_user)):
+        bucket.enforce(current_user["email"])
+    return dependency
+
+def is_trusted_proxy(host: str) -> bool:
+    try:
+        address = ipaddress.ip_address(host)
+    except ValueError:
+        return False
+    return any(address in network for network in TRUSTED_PROXIES)
+
+def client_ip(request: Request) -> str:
+    """The caller's address, looking through X-Forwarded-For as far as trusted proxies go"""
+    host = request.client.host if request.client else "unknown"
+    if not is_trusted_proxy(host):
+        return host
+    forwarded = [hop.strip() for hop in request.headers.get("x-forwarded-for", "").split(",") if hop.strip()]
+    # The rightmost hop not added by one of our proxies is the one nobody could spoof
+    for hop in reversed(forwarded):
+        if not is_trusted_proxy(hop):
+            return hop
+    return forwarded[0] if forwarded else host
+
+def rate_limit_client(bucket: TokenBucket):
+    async def dependency(request: Request):
+        bucket.enforce(client_ip(request))
+    return dependency
+
+# Expensive routes get a few concurrent slots each so cheap reads keep their latency
+auth_limiter = RouteLimiter(max_concurrent=4, max_queue=32, queue_timeout=5.0)
+upload_limiter = RouteLimiter(max_concurrent=2, max_queue=8, queue_timeout=10.0)
+purchase_limiter = RouteLimiter(max_concurrent=8, max_queue=32, queue_timeout=10.0)
+
+auth_rate_limit = rate_limit_client(TokenBucket("auth", per_minute=10, burst=10))
+upload_rate_limit = rate_limit_user(TokenBucket("upload", per_minute=10, burst=5))
+purchase_rate_limit = rate_limit_user(TokenBucket("purchase", per_minute=30, burst=10))
+
 def extract_pdf_text(file_path: str) -> str:
     """Extract text from PDF file"""
     try:
@@ -135,6 +624,47 @@ def extract_pdf_text(file_path: str) -> str:
     except Exception as e:
         return f"Fel vid textextraktion: {str(e)}"
 
+# Previews
+PREVIEW_PAGES = 2
+PREVIEW_EXCERPT_CHARS = 1500
+
+def preview_key(preview_filename: str) -> str:
+    return f"previews/{preview_filename}"
+
+def generate_preview(note_id: str, filename: str, file_id: str):
+    """Cut the first pages of an uploaded PDF into a small preview PDF and text excerpt"""
+    preview_filename = f"{file_id}_preview.pdf"
+    try:
+        with file_storage.open(filename) as file:
+            pdf_reader = PyPDF2.PdfReader(file)
+            # Always hold back at least one page, or a short note's preview would be the whole note
+            preview_pages = min(PREVIEW_PAGES, len(pdf_reader.pages) - 1)
+            if preview_pages < 1:
+                notes_collection.update_one({"id": note_id}, {"$set": {"preview_status": "unavailable"}})
+                return
+            pdf_writer = PyPDF2.PdfWriter()
+            excerpt = ""
+            for page in pdf_reader.pages[:preview_pages]:
+                pdf_writer.add_page(page)
+                excerpt += page.extract_text()
+            with tempfile.SpooledTemporaryFile() as preview:
+                pdf_writer.write(preview)
+                preview.seek(0)
+                file_storage.save(preview_key(preview_filename), preview)
+    except Exception:
+        notes_collection.update_one({"id": note_id}, {"$set": {"preview_status": "failed"}})
+        return
+
+    notes_collection.update_one(
+        {"id": note_id},
+        {"$set": {
+            "preview_status": "ready",
+            "preview_filename": preview_filename,
+            "preview_pages": preview_pages,
+            "preview_excerpt": excerpt[:PREVIEW_EXCERPT_CHARS]
+        }}
+    )
+
 def mock_ai_summarize(text: str) -> str:
     """Mock AI summarization"""
     summaries = [
@@ -181,8 +711,1488 @@ def mock_ai_quiz(text: str) -> List[dict]:
     ]
     return random.sample(quizzes, min(2, len(quizzes)))
 
+def process_note_file(file_path: str) -> dict:
+    """Extract text and generate AI content for one PDF, run in the note worker pool"""
+    pdf_text = extract_pdf_text(file_path)
+    time.sleep(1)  # Simulate AI processing time
+    summary = mock_ai_summarize(pdf_text)
+    return {
+        "summary": summary,
+        "flashcards": mock_ai_flashcards(pdf_text),
+        "quiz": mock_ai_quiz(pdf_text),
+        "minhash": minhash_signature(pdf_text),
+        "body_terms": note_body_terms(pdf_text, summary)
+    }
+
+def new_note_doc(details: NoteUpload, filename: str, current_user: dict, generated: dict) -> dict:
+    # Flag likely re-uploads of notes already on the platform
+    possible_duplicates = duplicate_index.query(generated["minhash"]) if generated.get("minhash") else []
+    return {
+        "id": str(uuid.uuid4()),
+        "title": details.title,
+        "university": details.university,
+        "course_code": details.course_code,
+        "book_reference": details.book_reference,
+        "description": details.description,
+        "price": details.price,
+        "filename": filename,
+        "file_path": file_storage.location(filename),
+        "uploader_email": current_user["email"],
+        "uploader_name": current_user["name"],
+        "created_at": datetime.utcnow(),
+        "summary": generated["summary"],
+        "flashcards": generated["flashcards"],
+        "quiz": generated["quiz"],
+        "downloads": 0,
+        "views": 0,
+        "file_downloads": 0,
+        "rating": 0.0,
+        "rating_count": 0,
+        "comments": [],
+        "is_deleted": False,
+        "preview_status": "pending",
+        "possible_duplicates": possible_duplicates
+    }
+
+# Bulk uploads
+BULK_UPLOAD_MAX_FILES = 50
+note_worker_pool = None
+
+def get_note_worker_pool() -> ProcessPoolExecutor:
+    """Process pool for PDF extraction, so bulk uploads scale with cores instead of the GIL"""
+    global note_worker_pool
+    if note_worker_pool is None:
+        note_worker_pool = ProcessPoolExecutor(
+            max_workers=max(2, os.cpu_count() or 1),
+            mp_context=multiprocessing.get_context("spawn")
+        )
+    return note_worker_pool
+
+NOTE_WORKER_RETRIES = 1
+
+def discard_note_worker_pool(pool: ProcessPoolExecutor):
+    """Drop a pool whose worker died, so the next caller starts a fresh one"""
+    global note_worker_pool
+    if note_worker_pool is pool:
+        note_worker_pool = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+async def run_in_note_worker(fn, *args):
+    """Run fn in the note worker pool, retrying on a fresh pool if a worker died"""
+    loop = asyncio.get_running_loop()
+    for attempt in range(NOTE_WORKER_RETRIES + 1):
+        pool = get_note_worker_pool()
+        try:
+            return await loop.run_in_executor(pool, fn, *args)
+        except BrokenProcessPool:
+            discard_note_worker_pool(pool)
+            if attempt == NOTE_WORKER_RETRIES:
+                raise
+
+def map_in_note_workers(fn, items: list) -> list:
+    """fn over items in the note worker pool; items that kept killing workers come back as BrokenProcessPool"""
+    results = [None] * len(items)
+    remaining = list(range(len(items)))
+    for _ in range(NOTE_WORKER_RETRIES + 1):
+        pool = get_note_worker_pool()
+        futures = {}
+        for i in remaining:
+            try:
+                futures[i] = pool.submit(fn, items[i])
+            except BrokenProcessPool as e:
+                results[i] = e
+        broken = [i for i in remaining if i not in futures]
+        for i, future in futures.items():
+            try:
+                results[i] = future.result()
+            except BrokenProcessPool as e:
+                results[i] = e
+                broken.append(i)
+        if not broken:
+            break
+        discard_note_worker_pool(pool)
+        remaining = sorted(broken)
+    return results
+
+def save_bulk_files(files: List[UploadFile]) -> List[dict]:
+    """Stream uploaded PDFs, and PDFs inside uploaded zips, to file storage"""
+    saved = []
+
+    def save(name: str, source):
+        if len(saved) >= BULK_UPLOAD_MAX_FILES:
+            saved.append({"original_filename": name, "error": f"Högst {BULK_UPLOAD_MAX_FILES} filer per uppladdning"})
+            return
+        file_id = str(uuid.uuid4())
+        filename = f"{file_id}_{name}"
+        file_storage.save(filename, source)
+        saved.append({"original_filename": name, "file_id": file_id, "filename": filename, "file_path": file_storage.local_path(filename)})
+
+    for file in files:
+        if file.filename.endswith('.zip'):
+            try:
+                with zipfile.ZipFile(file.file) as archive:
+                    for member in archive.infolist():
+                        name = os.path.basename(member.filename)
+                        if member.is_dir() or not name:
+                            continue
+                        if not name.endswith('.pdf'):
+                            saved.append({"original_filename": name, "error": "Endast PDF-filer är tillåtna"})
+                            continue
+                        with archive.open(member) as source:
+                            save(name, source)
+            except zipfile.BadZipFile:
+                saved.append({"original_filename": file.filename, "error": "Ogiltig zip-fil"})
+        elif not upload_filename(file.filename):
+            saved.append({"original_filename": file.filename, "error": "Ogiltigt filnamn"})
+        elif file.filename.endswith('.pdf'):
+            save(upload_filename(file.filename), file.file)
+        else:
+            saved.append({"original_filename": file.filename, "error": "Endast PDF-filer är tillåtna"})
+    return saved
+
+@app.on_event("shutdown")
+def shutdown_note_worker_pool():
+    if note_worker_pool is not None:
+        note_worker_pool.shutdown(wait=False, cancel_futures=True)
+
+# Leaderboards
+TRENDING_HALF_LIFE_DAYS = 7.0
+TRENDING_REBASE_DAYS = 52 * TRENDING_HALF_LIFE_DAYS  # Weights reach 2**52 before scores are rescaled
+TRENDING_WEIGHTS = {"purchase": 3.0, "download": 1.0, "rating": 1.0}
+RATING_PRIOR_MEAN = 3.0
+RATING_PRIOR_COUNT = 5
+
+def trending_weight(when: datetime, epoch: datetime) -> float:
+    """Growth factor that makes newer events outweigh older ones"""
+    # Scaling new events up instead of decaying old ones keeps every stored score valid
+    days = (when - epoch).total_seconds() / 86400.0
+    return 2.0 ** (days / TRENDING_HALF_LIFE_DAYS)
+
+def bayesian_rating(rating: float, rating_count: int) -> float:
+    """Average rating pulled towards the prior so a single 5 doesn't top the board"""
+    return (RATING_PRIOR_MEAN * RATING_PRIOR_COUNT + rating * rating_count) / (RATING_PRIOR_COUNT + rating_count)
+
+class Leaderboard:
+    """Note scores kept in rank order so top-k reads are a slice"""
+
+    def __init__(self):
+        self.scores = {}
+        self._ranked = []  # (-score, note_id)
+
+    def set(self, note_id: str, score: float):
+        self.remove(note_id)
+        self.scores[note_id] = score
+        bisect.insort(self._ranked, (-score, note_id))
+
+    def remove(self, note_id: str):
+        score = self.scores.pop(note_id, None)
+        if score is not None:
+            del self._ranked[bisect.bisect_left(self._ranked, (-score, note_id))]
+
+    def load(self, scores: dict):
+        self.scores = dict(scores)
+        self._ranked = sorted((-score, note_id) for note_id, score in scores.items())
+
+    def top(self, k: int) -> List[tuple]:
+        return [(note_id, -score) for score, note_id in self._ranked[:k]]
+
+def leaderboard_scopes(note: dict) -> List[tuple]:
+    """Boards a note is ranked on: overall, university, course code and both"""
+    university = (note.get("university") or "").strip().lower()
+    course_code = "".join((note.get("course_code") or "").split()).upper()
+    return [("all", ""), ("university", university), ("course", course_code), ("university_course", f"{university}|{course_code}")]
+
+class LeaderboardIndex:
+    """Trending and top-rated boards per university and course code"""
+
+    def __init__(self):
+        self.scopes = {}  # note_id -> scopes the note is ranked on
+        self.trending = {}  # note_id -> growth-scaled trending score
+        self.top_rated = {}  # note_id -> bayesian rating, rated notes only
+        self.boards = {"trending": defaultdict(Leaderboard), "top-rated": defaultdict(Leaderboard)}
+        self.epoch = datetime.utcnow()  # Trending scores are scaled relative to this instant
+        self._lock = threading.Lock()
+
+    def load(self, notes: List[dict], events: List[tuple]):
+        """Rebuild every board from active notes and (note_id, kind, when, value) events"""
+        scopes = {note["id"]: leaderboard_scopes(note) for note in notes}
+        epoch = datetime.utcnow()
+        trending = {note_id: 0.0 for note_id in scopes}
+        for note_id, kind, when, value in events:
+            if note_id in trending:
+                trending[note_id] += self._event_score(kind, when, value, epoch)
+        top_rated = {
+            note["id"]: bayesian_rating(note.get("rating", 0.0), note["rating_count"])
+            for note in notes if note.get("rating_count")
+        }
+
+        boards = {"trending": defaultdict(dict), "top-rated": defaultdict(dict)}
+        for board, scores in (("trending", trending), ("top-rated", top_rated)):
+            for note_id, score in scores.items():
+                for scope in scopes[note_id]:
+                    boards[board][scope][note_id] = score
+
+        with self._lock:
+            self.scopes, self.trending, self.top_rated = scopes, trending, top_rated
+            self.epoch = epoch
+            self.boards = {"trending": defaultdict(Leaderboard), "top-rated": defaultdict(Leaderboard)}
+            for board, by_scope in boards.items():
+                for scope, scores in by_scope.items():
+                    self.boards[board][scope].load(scores)
+
+    @staticmethod
+    def _event_score(kind: str, when: datetime, value: float, epoch: datetime) -> float:
+        return TRENDING_WEIGHTS[kind] * value * trending_weight(when, epoch)
+
+    def _rebase(self, epoch: datetime):
+        """Move the epoch forward and shrink trending scores to match, keeping their order"""
+        factor = trending_weight(self.epoch, epoch)
+        self.trending = {note_id: score * factor for note_id, score in self.trending.items()}
+        for board in self.boards["trending"].values():
+            board.load({note_id: self.trending[note_id] for note_id in board.scores})
+        self.epoch = epoch
+
+    def _set(self, board: str, note_id: str, score: float):
+        for scope in self.scopes[note_id]:
+            self.boards[board][scope].set(note_id, score)
+
+    def place(self, note: dict):
+        """Add a note or move it after its university or course code changed"""
+        with self._lock:
+            old_scopes = self.scopes.get(note["id"], [])
+            for scope in old_scopes:
+                self.boards["trending"][scope].remove(note["id"])
+                self.boards["top-rated"][scope].remove(note["id"])
+            self.scopes[note["id"]] = leaderboard_scopes(note)
+            self._set("trending", note["id"], self.trending.setdefault(note["id"], 0.0))
+            if note["id"] in self.top_rated:
+                self._set("top-rated", note["id"], self.top_rated[note["id"]])
+
+    def remove(self, note_id: str):
+        with self._lock:
+            for scope in self.scopes.pop(note_id, []):
+                self.boards["trending"][scope].remove(note_id)
+                self.boards["top-rated"][scope].remove(note_id)
+            self.trending.pop(note_id, None)
+            self.top_rated.pop(note_id, None)
+
+    def record(self, note_id: str, kind: str, value: float = 1.0, when: Optional[datetime] = None):
+        """Add a purchase, download or rating event to a note's trending score"""
+        with self._lock:
+            if note_id not in self.scopes:
+                return
+            when = when or datetime.utcnow()
+            if (when - self.epoch).days > TRENDING_REBASE_DAYS:
+                self._rebase(when)
+            self.trending[note_id] += self._event_score(kind, when, value, self.epoch)
+            self._set("trending", note_id, self.trending[note_id])
+
+    def rate(self, note_id: str, rating: float, rating_count: int):
+        with self._lock:
+            if note_id not in self.scopes:
+                return
+            self.top_rated[note_id] = bayesian_rating(rating, rating_count)
+            self._set("top-rated", note_id, self.top_rated[note_id])
+
+    def top(self, board: str, scope: tuple, k: int) -> List[tuple]:
+        """Top k (note_id, score) pairs, trending scores decayed to the current time"""
+        with self._lock:
+            ranked = self.boards[board][scope].top(k) if scope in self.boards[board] else []
+            epoch = self.epoch
+        if board == "trending":
+            now_weight = trending_weight(datetime.utcnow(), epoch)
+            ranked = [(note_id, score / now_weight) for note_id, score in ranked]
+        return ranked
+
+leaderboards = LeaderboardIndex()
+
+def rating_event_value(rating: int) -> float:
+    """Ratings above 3 push a note up the trending board, ratings below pull it down"""
+    return (rating - RATING_PRIOR_MEAN) / 2.0
+
+# Facets
+FACET_FIELDS = ["university", "course_code", "pricing", "price_band", "rating_band"]
+
+def price_band(price: float) -> str:
+    if price <= 0:
+        return "0"
+    if price < 50:
+        return "1-49"
+    if price < 100:
+        return "50-99"
+    if price < 200:
+        return "100-199"
+    return "200+"
+
+def rating_band(rating: float, rating_count: int) -> str:
+    if not rating_count:
+        return "unrated"
+    low = min(int(rating), 4)
+    return f"{low}-{low + 1}"
+
+def note_facets(note: dict) -> dict:
+    price = note.get("price") or 0.0
+    return {
+        "university": note.get("university") or "",
+        "course_code": note.get("course_code") or "",
+        "pricing": "free" if price <= 0 else "paid",
+        "price_band": price_band(price),
+        "rating_band": rating_band(note.get("rating", 0.0), note.get("rating_count", 0))
+    }
+
+class FacetIndex:
+    """Facet values of every active note, inverted per field for counting"""
+
+    def __init__(self):
+        self.notes = {}  # note_id -> facet values
+        self.postings = {field: defaultdict(set) for field in FACET_FIELDS}
+        self._lock = threading.Lock()
+
+    def load(self, notes: List[dict]):
+        facets = {note["id"]: note_facets(note) for note in notes}
+        postings = {field: defaultdict(set) for field in FACET_FIELDS}
+        for note_id, values in facets.items():
+            for field, value in values.items():
+                postings[field][value].add(note_id)
+        with self._lock:
+            self.notes, self.postings = facets, postings
+
+    def _remove(self, note_id: str):
+        for field, value in self.notes.pop(note_id, {}).items():
+            ids = self.postings[field][value]
+            ids.discard(note_id)
+            if not ids:
+                del self.postings[field][value]
+
+    def add(self, note: dict):
+        with self._lock:
+            self._remove(note["id"])
+            self.notes[note["id"]] = note_facets(note)
+            for field, value in self.notes[note["id"]].items():
+                self.postings[field][value].add(note["id"])
+
+    def remove(self, note_id: str):
+        with self._lock:
+            self._remove(note_id)
+
+    def match(self, field: str, pattern: str) -> set:
+        """Ids of notes whose field matches a case-insensitive regex, like the search query"""
+        try:
+            regex = re.compile(pattern, re.IGNORECASE)
+        except re.error:
+            regex = re.compile(re.escape(pattern), re.IGNORECASE)
+        with self._lock:
+            return set().union(*(ids for value, ids in self.postings[field].items() if regex.search(value)))
+
+    def counts(self, note_ids: Optional[set] = None) -> dict:
+        """Facet counts for a set of matched notes, or for every active note"""
+        with self._lock:
+            if note_ids is None:
+                return {
+                    field: {value: len(ids) for value, ids in self.postings[field].items()}
+                    for field in FACET_FIELDS
+                }
+            counts = {field: defaultdict(int) for field in FACET_FIELDS}
+            for note_id in note_ids:
+                for field, value in self.notes.get(note_id, {}).items():
+                    counts[field][value] += 1
+        return {field: dict(values) for field, values in counts.items()}
+
+facet_index = FacetIndex()
+
+# Autocomplete
+AUTOCOMPLETE_FIELDS = ["course_code", "university", "book_reference"]
+
+class PrefixIndex:
+    """Distinct values of one field in a sorted array, weighted by note count"""
+
+    def __init__(self):
+        self.counts = {}  # value -> number of active notes
+        self._keys = []  # sorted (key, value) for the whole value and each later word
+        self._cache = {}
+
+    @staticmethod
+    def _value_keys(value: str) -> List[tuple]:
+        words = value.lower().split()
+        return [(" ".join(words[i:]), value) for i in range(len(words))]
+
+    def load(self, counts: dict):
+        self.counts = dict(counts)
+        self._keys = sorted(key for value in counts for key in self._value_keys(value))
+        self._cache = {}
+
+    def add(self, value: str):
+        self.counts[value] = self.counts.get(value, 0) + 1
+        if self.counts[value] == 1:
+            for key in self._value_keys(value):
+                bisect.insort(self._keys, key)
+        self._cache = {}
+
+    def discard(self, value: str):
+        if value not in self.counts:
+            return
+        self.counts[value] -= 1
+        if not self.counts[value]:
+            del self.counts[value]
+            for key in self._value_keys(value):
+                del self._keys[bisect.bisect_left(self._keys, key)]
+        self._cache = {}
+
+    def complete(self, prefix: str, k: int) -> List[dict]:
+        prefix = " ".join(prefix.lower().split())
+        cached = self._cache.get((prefix, k))
+        if cached is not None:
+            return cached
+
+        matches = set()
+        i = bisect.bisect_left(self._keys, (prefix,))
+        while i < len(self._keys) and self._keys[i][0].startswith(prefix):
+            matches.add(self._keys[i][1])
+            i += 1
+        best = heapq.nlargest(k, matches, key=lambda value: (self.counts[value], value))
+        result = [{"value": value, "count": self.counts[value]} for value in best]
+
+        if len(self._cache) < 10000:
+            self._cache[(prefix, k)] = result
+        return result
+
+class AutocompleteIndex:
+    """Prefix indexes over course codes, universities and book references of active notes"""
+
+    def __init__(self):
+        self.notes = {}  # note_id -> indexed values
+        self.fields = {field: PrefixIndex() for field in AUTOCOMPLETE_FIELDS}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _note_values(note: dict) -> dict:
+        return {field: (note.get(field) or "").strip() for field in AUTOCOMPLETE_FIELDS if (note.get(field) or "").strip()}
+
+    def load(self, notes: List[dict]):
+        values = {note["id"]: self._note_values(note) for note in notes}
+        counts = {field: defaultdict(int) for field in AUTOCOMPLETE_FIELDS}
+        for note_values in values.values():
+            for field, value in note_values.items():
+                counts[field][value] += 1
+        with self._lock:
+            self.notes = values
+            for field in AUTOCOMPLETE_FIELDS:
+                self.fields[field].load(counts[field])
+
+    def _remove(self, note_id: str):
+        for field, value in self.notes.pop(note_id, {}).items():
+            self.fields[field].discard(value)
+
+    def add(self, note: dict):
+        with self._lock:
+            self._remove(note["id"])
+            self.notes[note["id"]] = self._note_values(note)
+            for field, value in self.notes[note["id"]].items():
+                self.fields[field].add(value)
+
+    def remove(self, note_id: str):
+        with self._lock:
+            self._remove(note_id)
+
+    def complete(self, field: str, prefix: str, k: int) -> List[dict]:
+        with self._lock:
+            return self.fields[field].complete(prefix, k)
+
+autocomplete_index = AutocompleteIndex()
+
+# Duplicate detection
+MINHASH_PERMUTATIONS = 128
+# 16 bands of 8 rows: the candidate S-curve is centred near 0.707, so notes at 0.7 similarity share a
+# bucket ~60% of the time and notes at the 0.8 duplicate threshold ~95% of the time
+LSH_BANDS = 16
+DUPLICATE_THRESHOLD = 0.8
+SHINGLE_WORDS = 5
+MIN_SHINGLES = 20  # Too little text (scans, extraction errors) to tell notes apart
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_minhash_rng = np.random.RandomState(1)
+MINHASH_A = _minhash_rng.randint(1, (1 << 61) - 1, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+MINHASH_B = _minhash_rng.randint(0, (1 << 61) - 1, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+
+def minhash_signature(text: str) -> Optional[bytes]:
+    """MinHash of the text's word 5-shingles, or None when there is too little text"""
+    words = re.findall(r"\w+", text.lower())
+    shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+    if len(shingles) < MIN_SHINGLES:
+        return None
+    hashes = np.fromiter((zlib.crc32(shingle.encode()) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+
+    # (a * x + b) with uint64 wraparound, then mod p, per permutation; not a strict universal hash, but
+    # stored signatures depend on it. Chunked to bound memory on long texts
+    signature = np.full(MINHASH_PERMUTATIONS, np.iinfo(np.uint64).max, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        for start in range(0, len(hashes), 4096):
+            chunk = hashes[start:start + 4096, None]
+            permuted = (chunk * MINHASH_A + MINHASH_B) % MERSENNE_PRIME
+            signature = np.minimum(signature, permuted.min(axis=0))
+    return (signature & np.uint64(0xFFFFFFFF)).astype(np.uint32).tobytes()
+
+class DuplicateIndex:
+    """LSH buckets over note MinHash signatures for sub-linear near-duplicate lookups"""
+
+    def __init__(self):
+        self.signatures = {}  # note_id -> signature array
+        self.buckets = defaultdict(set)  # (band, band bytes) -> note ids
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _bands(signature: np.ndarray) -> List[tuple]:
+        return [(band, rows.tobytes()) for band, rows in enumerate(np.split(signature, LSH_BANDS))]
+
+    def load(self, signatures: dict):
+        with self._lock:
+            self.signatures, self.buckets = {}, defaultdict(set)
+            for note_id, signature in signatures.items():
+                self._add(note_id, signature)
+
+    def _add(self, note_id: str, signature: bytes):
+        self.signatures[note_id] = np.frombuffer(signature, dtype=np.uint32)
+        for key in self._bands(self.signatures[note_id]):
+            self.buckets[key].add(note_id)
+
+    def add(self, note_id: str, signature: bytes):
+        with self._lock:
+            self._remove(note_id)
+            self._add(note_id, signature)
+
+    def _remove(self, note_id: str):
+        signature = self.signatures.pop(note_id, None)
+        if signature is not None:
+            for key in self._bands(signature):
+                self.buckets[key].discard(note_id)
+                if not self.buckets[key]:
+                    del self.buckets[key]
+
+    def remove(self, note_id: str):
+        with self._lock:
+            self._remove(note_id)
+
+    def query(self, signature: bytes, exclude: Optional[str] = None) -> List[dict]:
+        """Indexed notes whose estimated Jaccard similarity passes DUPLICATE_THRESHOLD"""
+        signature = np.frombuffer(signature, dtype=np.uint32)
+        with self._lock:
+            candidates = set().union(*(self.buckets.get(key, ()) for key in self._bands(signature)))
+            candidates.discard(exclude)
+            matches = [
+                {"note_id": note_id, "similarity": float(np.mean(self.signatures[note_id] == signature))}
+                for note_id in candidates
+            ]
+        matches = [match for match in matches if match["similarity"] >= DUPLICATE_THRESHOLD]
+        return sorted(matches, key=lambda match: match["similarity"], reverse=True)
+
+duplicate_index = DuplicateIndex()
+
+def note_file_signature(file_path: str) -> Optional[bytes]:
+    return minhash_signature(extract_pdf_text(file_path))
+
+def scan_duplicates() -> int:
+    """Sign every active note that lacks a signature, then flag later copies of earlier notes"""
+    notes = {
+        note["id"]: note for note in notes_collection.find(
+            {"is_deleted": False},
+            {"_id": 0, "id": 1, "filename": 1, "created_at": 1}
+        )
+    }
+    signatures = {
+        row["note_id"]: row["minhash"] for row in note_signatures_collection.find(
+            {"note_id": {"$in": list(notes)}},
+            {"_id": 0, "note_id": 1, "minhash": 1}
+        )
+    }
+
+    # Extracting text is the slow part, so spread it over the note worker pool
+    unsigned = [note for note_id, note in notes.items() if note_id not in signatures]
+    paths = [file_storage.local_path(note["filename"]) for note in unsigned]
+    for note, signature in zip(unsigned, map_in_note_workers(note_file_signature, paths)):
+        if isinstance(signature, BrokenProcessPool):
+            continue  # Left unsigned so the next scan tries again
+        note_signatures_collection.update_one(
+            {"note_id": note["id"]},
+            {"$set": {"minhash": signature}},
+            upsert=True
+        )
+        if signature is not None:
+            signatures[note["id"]] = signature
+
+    signatures = {note_id: signature for note_id, signature in signatures.items() if signature is not None}
+    duplicate_index.load(signatures)
+    updates = []
+    for note_id, signature in signatures.items():
+        earlier = [
+            match for match in duplicate_index.query(signature, exclude=note_id)
+            if (notes[match["note_id"]]["created_at"], match["note_id"]) < (notes[note_id]["created_at"], note_id)
+        ]
+        if earlier:
+            updates.append(UpdateOne({"id": note_id}, {"$set": {"possible_duplicates": earlier}}))
+    if updates:
+        notes_collection.bulk_write(updates)
+    return len(updates)
+
+# Related notes
+TEXT_VECTOR_DIM = 1024
+TEXT_MAX_TERMS = 300
+TEXT_REBUILD_SECONDS = 3600
+TEXT_STOPWORDS = {
+    "och", "att", "det", "som", "en", "på", "är", "av", "för", "med", "till", "den", "har", "de", "inte", "om", "ett", "men", "var", "jag", "så", "kan", "vi",
+    "the", "and", "of", "to", "in", "is", "for", "on", "that", "with", "as", "are", "by", "be", "this", "an", "or", "it", "from", "at"
+}
+
+def text_term_counts(text: str) -> dict:
+    """Counts of the most frequent hashed terms in a text"""
+    counts = defaultdict(int)
+    for word in re.findall(r"\w{2,}", text.lower()):
+        if word not in TEXT_STOPWORDS:
+            counts[zlib.crc32(word.encode())] += 1
+    return dict(heapq.nlargest(TEXT_MAX_TERMS, counts.items(), key=lambda item: item[1]))
+
+def note_body_terms(pdf_text: str, summary: str) -> dict:
+    return text_term_counts(f"{summary} {pdf_text}")
+
+def note_metadata_terms(note: dict) -> dict:
+    # Title words count twice; they say more about a note than any body word
+    title = note.get("title") or ""
+    return text_term_counts(f"{title} {title} {note.get('description') or ''}")
+
+class TextIndex:
+    """Hashed TF-IDF vectors of active notes, one L2-normalised float32 row per note"""
+
+    def __init__(self):
+        self.body_terms = {}  # note_id -> term counts of extracted text and summary
+        self.note_terms = {}  # note_id -> term counts behind the note's current row
+        self.doc_freq = defaultdict(int)
+        self.rows = {}  # note_id -> matrix row
+        self.row_ids = []  # matrix row -> note_id, None when free
+        self.free_rows = []
+        self.matrix = np.zeros((0, TEXT_VECTOR_DIM), dtype=np.float32)
+        self._lock = threading.Lock()
+
+    def _vector(self, terms: dict) -> np.ndarray:
+        return self._weigh(terms, self.doc_freq, len(self.note_terms))
+
+    @staticmethod
+    def _weigh(terms: dict, doc_freq: dict, doc_count: int) -> np.ndarray:
+        vector = np.zeros(TEXT_VECTOR_DIM, dtype=np.float32)
+        if not terms:
+            return vector
+        ids = np.fromiter(terms.keys(), dtype=np.uint64, count=len(terms))
+        tf = np.fromiter(terms.values(), dtype=np.float64, count=len(terms))
+        df = np.fromiter((doc_freq.get(term, 0) for term in terms), dtype=np.float64, count=len(terms))
+        # doc_count comes from note_terms, which load() fills before any row exists
+        weights = (1 + np.log(tf)) * (np.log((1 + doc_count) / (1 + df)) + 1)
+        # Feature hashing: the top hash bit picks the sign so bucket collisions cancel out on average
+        signs = np.where((ids >> np.uint64(31)) & np.uint64(1), 1.0, -1.0)
+        np.add.at(vector, (ids % np.uint64(TEXT_VECTOR_DIM)).astype(np.intp), signs * weights)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    @staticmethod
+    def _merge(body: dict, metadata: dict) -> dict:
+        terms = dict(body)
+        for term, count in metadata.items():
+            terms[term] = terms.get(term, 0) + count
+        return terms
+
+    def _set_row(self, note_id: str, vector: np.ndarray):
+        if note_id not in self.rows:
+            if self.free_rows:
+                row = self.free_rows.pop()
+                self.row_ids[row] = note_id
+            else:
+                row = len(self.row_ids)
+                self.row_ids.append(note_id)
+                if row >= len(self.matrix):
+                    grown = np.zeros((max(64, 2 * len(self.matrix)), TEXT_VECTOR_DIM), dtype=np.float32)
+                    grown[:len(self.matrix)] = self.matrix
+                    self.matrix = grown
+            self.rows[note_id] = row
+        self.matrix[self.rows[note_id]] = vector
+
+    def _forget(self, note_id: str):
+        for term in self.note_terms.pop(note_id, {}):
+            self.doc_freq[term] -= 1
+            if not self.doc_freq[term]:
+                del self.doc_freq[term]
+
+    def load(self, notes: List[dict], bodies: dict):
+        """Rebuild every row from active notes and their stored body terms"""
+        with self._lock:
+            self.body_terms = {note["id"]: bodies.get(note["id"], {}) for note in notes}
+            self.note_terms = {note["id"]: self._merge(self.body_terms[note["id"]], note_metadata_terms(note)) for note in notes}
+            self.doc_freq = defaultdict(int)
+            for terms in self.note_terms.values():
+                for term in terms:
+                    self.doc_freq[term] += 1
+            self.rows, self.row_ids, self.free_rows = {}, [], []
+            self.matrix = np.zeros((max(64, len(self.note_terms)), TEXT_VECTOR_DIM), dtype=np.float32)
+            for note_id, terms in self.note_terms.items():
+                self._set_row(note_id, self._vector(terms))
+
+    def rebuild(self):
+        """Recompute every row with current document frequencies"""
+        # Weigh a snapshot without the lock so similarity lookups keep running meanwhile
+        with self._lock:
+            note_terms, doc_freq = dict(self.note_terms), dict(self.doc_freq)
+        vectors = {note_id: self._weigh(terms, doc_freq, len(note_terms)) for note_id, terms in note_terms.items()}
+
+        with self._lock:
+            # Notes added, changed or removed since the snapshot already have current rows
+            unchanged = [note_id for note_id, terms in note_terms.items() if self.note_terms.get(note_id) is terms]
+            if unchanged:
+                self.matrix[[self.rows[note_id] for note_id in unchanged]] = np.stack([vectors[note_id] for note_id in unchanged])
+
+    def set_body(self, note_id: str, terms: dict):
+        with self._lock:
+            self.body_terms[note_id] = terms
+
+    def add(self, note: dict):
+        """Index a new note, or re-index one whose title or description changed"""
+        with self._lock:
+            self._forget(note["id"])
+            terms = self._merge(self.body_terms.get(note["id"], {}), note_metadata_terms(note))
+            self.note_terms[note["id"]] = terms
+            for term in terms:
+                self.doc_freq[term] += 1
+            self._set_row(note["id"], self._vector(terms))
+
+    def remove(self, note_id: str):
+        with self._lock:
+            self._forget(note_id)
+            self.body_terms.pop(note_id, None)
+            row = self.rows.pop(note_id, None)
+            if row is not None:
+                self.matrix[row] = 0.0
+                self.row_ids[row] = None
+                self.free_rows.append(row)
+
+    def similar(self, note_id: str, k: int) -> List[tuple]:
+        """Top k notes by cosine similarity to a note"""
+        with self._lock:
+            row = self.rows.get(note_id)
+            if row is None:
+                return []
+            scores = self.matrix[:len(self.row_ids)] @ self.matrix[row]
+            scores[row] = 0.0
+            k = min(k, len(scores))
+            if k == 0:
+                return []
+            top = np.argpartition(-scores, k - 1)[:k]
+            top = top[np.argsort(-scores[top])]
+            return [(self.row_ids[i], float(scores[i])) for i in top if scores[i] > 0]
+
+text_index = TextIndex()
+
+def index_note(note: dict):
+    """Refresh the in-memory indexes after a note was uploaded or edited"""
+    leaderboards.place(note)
+    facet_index.add(note)
+    autocomplete_index.add(note)
+    text_index.add(note)
+
+def unindex_note(note_id: str):
+    leaderboards.remove(note_id)
+    facet_index.remove(note_id)
+    autocomplete_index.remove(note_id)
+    duplicate_index.remove(note_id)
+    text_index.remove(note_id)
+
+def load_leaderboards(notes: List[dict]):
+    events = []
+    for payment in payments_collection.find({"status": "completed"}, {"_id": 0, "note_id": 1, "created_at": 1}):
+        events.append((payment["note_id"], "purchase", payment["created_at"], 1.0))
+        events.append((payment["note_id"], "download", payment["created_at"], 1.0))
+    for note in notes:
+        for comment in note.get("comments", []):
+            events.append((note["id"], "rating", comment["created_at"], rating_event_value(comment["rating"])))
+    leaderboards.load(notes, events)
+
+@app.on_event("startup")
+def load_indexes():
+    notes = list(notes_collection.find(
+        {"is_deleted": False},
+        {"_id": 0, "id": 1, "title": 1, "description": 1, "university": 1, "course_code": 1, "book_reference": 1, "price": 1, "rating": 1, "rating_count": 1, "comments.rating": 1, "comments.created_at": 1}
+    ))
+    load_leaderboards(notes)
+    facet_index.load(notes)
+    autocomplete_index.load(notes)
+    active_ids = {note["id"] for note in notes}
+    duplicate_index.load({
+        row["note_id"]: row["minhash"] for row in note_signatures_collection.find(
+            {"minhash": {"$ne": None}},
+            {"_id": 0, "note_id": 1, "minhash": 1}
+        )
+        if row["note_id"] in active_ids
+    })
+    text_index.load(notes, {
+        row["note_id"]: dict(zip(row["terms"], row["counts"])) for row in note_terms_collection.find(
+            {}, {"_id": 0, "note_id": 1, "terms": 1, "counts": 1}
+        )
+        if row["note_id"] in active_ids
+    })
+
+@app.on_event("startup")
+def start_text_index_rebuild():
+    start_periodic("text-index-rebuild", TEXT_REBUILD_SECONDS, text_index.rebuild)
+
+# Database indexes
+ACTIVE_NOTES = {"is_deleted": False}
+
+@app.on_event("startup")
+def ensure_indexes():
+    notes_collection.create_index("id", unique=True)
+    notes_collection.create_index("uploader_email")
+    notes_collection.create_index([("is_deleted", 1), ("deleted_at", 1)])
+    # Hot queries only ever look at active notes, so keep deleted ones out of their indexes
+    notes_collection.create_index([("university", 1), ("course_code", 1)], partialFilterExpression=ACTIVE_NOTES)
+    notes_collection.create_index("course_code", partialFilterExpression=ACTIVE_NOTES)
+    notes_collection.create_index("book_reference", partialFilterExpression=ACTIVE_NOTES)
+    notes_collection.create_index([("created_at", -1)], partialFilterExpression=ACTIVE_NOTES)
+    notes_archive_collection.create_index("id", unique=True)
+    notes_archive_collection.create_index([("uploader_email", 1), ("created_at", -1)])
+    note_signatures_collection.create_index("note_id", unique=True)
+    note_terms_collection.create_index("note_id", unique=True)
+    users_collection.create_index("email")
+    payments_collection.create_index([("buyer_email", 1), ("created_at", -1)])
+    payments_collection.create_index([("seller_email", 1), ("created_at", -1)])
+    payments_collection.create_index([("note_id", 1), ("created_at", -1)])
+    withdrawals_collection.create_index([("user_email", 1), ("created_at", -1)])
+    withdrawals_collection.create_index([("status", 1), ("created_at", 1)])
+    withdrawals_collection.create_index("batch_id", sparse=True)
+
+# Background jobs
+background_stop = threading.Event()
+
+def start_periodic(name: str, interval: float, job):
+    """Run job every interval seconds on a daemon thread until shutdown"""
+    def run():
+        while not background_stop.wait(interval):
+            try:
+                job()
+            except Exception:
+                logger.exception("Background job %s failed, retrying in %ss", name, interval)
+    threading.Thread(target=run, name=name, daemon=True).start()
+
+@app.on_event("shutdown")
+def stop_background_jobs():
+    background_stop.set()
+
+# Write-behind counters
+COUNTER_FLUSH_SECONDS = 5  # Upper bound on how long an increment stays out of the database
+COUNTER_FIELDS = ("downloads", "views", "file_downloads")
+
+class CounterBuffer:
+    """Per-note counter increments held in memory and written to the notes collection in batches"""
+
+    def __init__(self):
+        self.pending = defaultdict(int)  # (note_id, field) -> delta
+        self.flushing = {}  # Deltas being written, still counted by merge until the write returns
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # One flush at a time, so flushing belongs to a single write
+
+    def incr(self, note_id: str, field: str, amount: int = 1):
+        with self._lock:
+            self.pending[(note_id, field)] += amount
+
+    def merge(self, note: dict) -> dict:
+        """Add deltas not yet flushed to a note's stored counters"""
+        with self._lock:
+            for field in COUNTER_FIELDS:
+                delta = self.pending.get((note["id"], field), 0) + self.flushing.get((note["id"], field), 0)
+                if delta:
+                    note[field] = note.get(field, 0) + delta
+        return note
+
+    def flush(self) -> List[str]:
+        """Write all pending deltas as one bulk write and return the ids of the notes it updated"""
+        with self._flush_lock:
+            with self._lock:
+                if not self.pending:
+                    return []
+                self.flushing, self.pending = dict(self.pending), defaultdict(int)
+                batch = self.flushing
+
+            by_note = defaultdict(dict)
+            for (note_id, field), delta in batch.items():
+                by_note[note_id][field] = delta
+            note_ids = list(by_note)
+            retry = {}
+            try:
+                notes_collection.bulk_write(
+                    [UpdateOne({"id": note_id}, {"$inc": by_note[note_id]}) for note_id in note_ids],
+                    ordered=False
+                )
+            except pymongo.errors.BulkWriteError as e:
+                # Only the failed updates go back; the rest were applied
+                failed = {note_ids[error["index"]] for error in e.details.get("writeErrors", [])}
+                retry = {key: delta for key, delta in batch.items() if key[0] in failed}
+                raise
+            except pymongo.errors.PyMongoError:
+                retry = batch
+                raise
+            finally:
+                with self._lock:
+                    for key, delta in retry.items():
+                        self.pending[key] += delta
+                    self.flushing = {}
+            return note_ids
+
+counter_buffer = CounterBuffer()
+
+def flush_counter_buffer():
+    # Cached dashboard rows hold the stored counts, which the flush just moved
+    dashboard_cache.invalidate_notes(counter_buffer.flush())
+
+@app.on_event("startup")
+def start_counter_flusher():
+    start_periodic("counter-flush", COUNTER_FLUSH_SECONDS, flush_counter_buffer)
+
+@app.on_event("shutdown")
+def flush_counters():
+    try:
+        flush_counter_buffer()
+    except pymongo.errors.PyMongoError:
+        pass  # Nothing left to retry with once the process exits
+
+# Archive
+ARCHIVE_GRACE_DAYS = 30
+ARCHIVE_INTERVAL_SECONDS = 3600
+
+def find_note(note_id: str, projection: Optional[dict] = None) -> Optional[dict]:
+    """Look a note up in the hot collection, then in the archive"""
+    note = notes_collection.find_one({"id": note_id}, projection)
+    if note is None:
+        note = notes_archive_collection.find_one({"id": note_id}, projection)
+    return note
+
+def archive_note_file(note: dict) -> Optional[str]:
+    """Gzip a note's file into cold storage and return its cold storage key"""
+    if not note.get("file_path") or not file_storage.exists(note["filename"]):
+        return None
+    cold_key = f"{note['filename']}.gz"
+    with file_storage.open(note["filename"]) as source, tempfile.TemporaryFile() as compressed:
+        with gzip.GzipFile(fileobj=compressed, mode="wb") as target:
+            shutil.copyfileobj(source, target)
+        compressed.seek(0)
+        cold_storage.save(cold_key, compressed)
+    return cold_key
+
+def archive_deleted_notes() -> int:
+    """Move notes deleted before the grace period, with no purchases inside it, to the archive"""
+    # Buyers keep access to archived notes; the grace period only covers recent buyers and refunds
+    cutoff = datetime.utcnow() - timedelta(days=ARCHIVE_GRACE_DAYS)
+    candidates = [note["id"] for note in notes_collection.find(
+        {"is_deleted": True, "$or": [{"deleted_at": {"$lte": cutoff}}, {"deleted_at": {"$exists": False}}]},
+        {"_id": 0, "id": 1}
+    )]
+    if not candidates:
+        return 0
+    recently_sold = set(payments_collection.distinct("note_id", {"note_id": {"$in": candidates}, "created_at": {"$gt": cutoff}}))
+
+    archived = 0
+    for note_id in candidates:
+        if note_id in recently_sold:
+            continue
+        note = notes_collection.find_one({"id": note_id, "is_deleted": True})
+        if note is None:
+            continue
+        note.pop("_id", None)
+        hot_files = [note["filename"]]
+        if note.get("preview_filename"):
+            hot_files.append(preview_key(note["preview_filename"]))
+        note["cold_key"] = archive_note_file(note)
+        note["file_path"] = None
+        note["archived_at"] = datetime.utcnow()
+
+        # Write the archive copy first so a crash in between only leaves a duplicate to retry
+        notes_archive_collection.replace_one({"id": note_id}, note, upsert=True)
+        notes_collection.delete_one({"id": note_id, "is_deleted": True})
+        for key in hot_files:
+            file_storage.delete(key)
+        archived += 1
+    return archived
+
+@app.on_event("startup")
+def start_archiver():
+    start_periodic("note-archiver", ARCHIVE_INTERVAL_SECONDS, archive_deleted_notes)
+
+# Seller dashboard
+DASHBOARD_CACHE_SECONDS = 60  # Bounds staleness across workers; local changes invalidate immediately
+DASHBOARD_CACHE_MAX_ENTRIES = 10000
+DASHBOARD_RECENT_SALES = 5
+
+class DashboardCache:
+    """Seller dashboard pages cached until the seller's next sale or note change"""
+
+    def __init__(self):
+        self.entries = OrderedDict()  # (email, page key) -> (expires, page)
+        self.by_seller = defaultdict(set)
+        self.note_sellers = {}  # note_id -> seller, for notes on cached pages
+        self._lock = threading.Lock()
+
+    def get(self, email: str, key: tuple) -> Optional[dict]:
+        with self._lock:
+            entry = self.entries.get((email, key))
+            if entry is None or entry[0] < time.monotonic():
+                return None
+            self.entries.move_to_end((email, key))
+            return entry[1]
+
+    def put(self, email: str, key: tuple, page: dict):
+        with self._lock:
+            self.entries[(email, key)] = (time.monotonic() + DASHBOARD_CACHE_SECONDS, page)
+            self.entries.move_to_end((email, key))
+            self.by_seller[email].add(key)
+            for note in page["notes"]:
+                self.note_sellers[note["id"]] = email
+            while len(self.entries) > DASHBOARD_CACHE_MAX_ENTRIES:
+                (old_email, old_key), _ = self.entries.popitem(last=False)
+                self.by_seller[old_email].discard(old_key)
+                if not self.by_seller[old_email]:
+                    del self.by_seller[old_email]
+
+    def invalidate(self, email: str):
+        with self._lock:
+            for key in self.by_seller.pop(email, ()):
+                self.entries.pop((email, key), None)
+
+    def invalidate_notes(self, note_ids: List[str]):
+        """Drop the cached pages of every seller owning one of note_ids"""
+        with self._lock:
+            sellers = {self.note_sellers.pop(note_id) for note_id in note_ids if note_id in self.note_sellers}
+        for email in sellers:
+            self.invalidate(email)
+
+dashboard_cache = DashboardCache()
+
+def encode_cursor(note: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps([note["created_at"].isoformat(), note["id"]]).encode()).decode()
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        created_at, note_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), note_id
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Ogiltig sidmarkör")
+
+def dashboard_notes_stages(email: str, limit: int, cursor: Optional[str], include_deleted: bool) -> List[dict]:
+    """The seller's notes for one page, newest first, plus one more to tell whether another page follows"""
+    match = {"uploader_email": email}
+    if not include_deleted:
+        match["is_deleted"] = False
+    if cursor:
+        created_at, note_id = decode_cursor(cursor)
+        match["$or"] = [{"created_at": {"$lt": created_at}}, {"created_at": created_at, "id": {"$lt": note_id}}]
+
+    stages = [{"$match": match}]
+    if include_deleted:
+        # Archived notes are deleted notes too, and keep their sales
+        stages.append({"$unionWith": {"coll": notes_archive_collection.name, "pipeline": [{"$match": match}]}})
+    return stages + [
+        {"$sort": {"created_at": -1, "id": -1}},
+        {"$limit": limit + 1}
+    ]
+
+def dashboard_sales_lookup() -> dict:
+    """Revenue and recent sales per note from payments, as a one-element "sales" array of facets"""
+    return {"$lookup": {
+        "from": payments_collection.name,
+        "let": {"note_id": "$id"},
+        "pipeline": [
+            {"$match": {"$expr": {"$eq": ["$note_id", "$$note_id"]}, "status": "completed"}},
+            {"$facet": {
+                "totals": [{"$group": {"_id": None, "revenue": {"$sum": "$seller_amount"}, "sales": {"$sum": 1}}}],
+                "recent": [
+                    {"$sort": {"created_at": -1}},
+                    {"$limit": DASHBOARD_RECENT_SALES},
+                    {"$project": {"_id": 0, "payment_id": "$id", "amount": "$seller_amount", "created_at": 1}}
+                ]
+            }}
+        ],
+        "as": "sales"
+    }}
+
+DASHBOARD_ROW_PROJECTION = {
+    "_id": 0,
+    "id": 1,
+    "title": 1,
+    "university": 1,
+    "course_code": 1,
+    "price": 1,
+    "created_at": 1,
+    "is_deleted": 1,
+    "downloads": 1,
+    "views": 1,
+    "file_downloads": 1,
+    "rating": 1,
+    "rating_count": 1,
+    # sales is [{"totals": [{revenue, sales}] or [], "recent": [...]}]; missing when a note has no sales
+    "totals": {"$arrayElemAt": [{"$arrayElemAt": ["$sales.totals", 0]}, 0]},
+    "recent_sales": {"$arrayElemAt": ["$sales.recent", 0]}
+}
+
+def seller_dashboard_pipeline(email: str, limit: int, cursor: Optional[str], include_deleted: bool) -> List[dict]:
+    return dashboard_notes_stages(email, limit, cursor, include_deleted) + [
+        dashboard_sales_lookup(),
+        {"$project": DASHBOARD_ROW_PROJECTION}
+    ]
+
+def dashboard_page(rows: List[dict], limit: int, earnings: float) -> dict:
+    """Page response from up to limit + 1 pipeline rows"""
+    has_more = len(rows) > limit
+    notes = rows[:limit]
+    for note in notes:
+        totals = note.pop("totals", None) or {}
+        note["revenue"] = totals.get("revenue", 0.0)
+        note["sales"] = totals.get("sales", 0)
+        note["recent_sales"] = note.get("recent_sales") or []
+    return {
+        "earnings": earnings,
+        "notes": notes,
+        "next_cursor": encode_cursor(notes[-1]) if has_more else None
+    }
+
+# Withdrawal settlement
+MIN_WITHDRAWAL_AMOUNT = 150.0
+SETTLEMENT_INTERVAL_SECONDS = 10
+SETTLEMENT_BATCH_SIZE = 100
+SETTLEMENT_MAX_ATTEMPTS = 5
+SETTLEMENT_CLAIM_TIMEOUT = timedelta(minutes=10)
+
+class PayoutError(Exception):
+    pass
+
+class LocalPayoutProvider:
+    """Stand-in payout provider that settles batches idempotently by withdrawal id"""
+
+    def __init__(self, failure_rate: float = 0.0):
+        self.failure_rate = failure_rate
+        self.payouts = {}  # idempotency key -> payout id
+        self._lock = threading.Lock()
+
+    def send_batch(self, items: List[dict]) -> dict:
+        """Pay out every item, returning payout ids by idempotency key"""
+        if random.random() < self.failure_rate:
+            raise PayoutError("Betalningsleverantören svarade inte")
+        with self._lock:
+            return {item["idempotency_key"]: self.payouts.setdefault(item["idempotency_key"], str(uuid.uuid4())) for item in items}
+
+payout_provider = LocalPayoutProvider(failure_rate=float(os.environ.get('PAYOUT_FAILURE_RATE', '0')))
+
+def send_payouts(withdrawals: List[dict], retries: int = 3) -> dict:
+    items = [
+        {"idempotency_key": w["id"], "user_email": w["user_email"], "amount": w["amount"], "payment_method": w["payment_method"]}
+        for w in withdrawals
+    ]
+    for attempt in range(retries):
+        try:
+            return payout_provider.send_batch(items)
+        except PayoutError:
+            if attempt == retries - 1:
+                raise
+            time.sleep(0.5 * 2 ** attempt)
+
+def adjust_balances(totals: dict, withdrawn: bool, session=None):
+    """Release reserved amounts per user, moving them to withdrawn when paid out"""
+    users_collection.bulk_write([
+        UpdateOne({"email": email}, {"$inc": {"pending_withdrawal": -amount, "withdrawn": amount if withdrawn else 0.0}})
+        for email, amount in totals.items()
+    ], session=session)
+
+def settle_withdrawals() -> int:
+    """Claim a batch of pending withdrawals and pay them out"""
+    now = datetime.utcnow()
+    # Batches left behind by a crashed worker go back in the queue; payouts are idempotent
+    withdrawals_collection.update_many(
+        {"status": "processing", "claimed_at": {"$lt": now - SETTLEMENT_CLAIM_TIMEOUT}},
+        {"$set": {"status": "pending"}}
+    )
+
+    ids = [w["id"] for w in withdrawals_collection.find({"status": "pending"}, {"_id": 0, "id": 1}).sort("created_at", 1).limit(SETTLEMENT_BATCH_SIZE)]
+    if not ids:
+        return 0
+    batch_id = str(uuid.uuid4())
+    withdrawals_collection.update_many(
+        {"id": {"$in": ids}, "status": "pending"},
+        {"$set": {"status": "processing", "batch_id": batch_id, "claimed_at": now}}
+    )
+    batch = list(withdrawals_collection.find({"batch_id": batch_id, "status": "processing"}, {"_id": 0}))
+    if not batch:
+        return 0
+
+    try:
+        payout_ids = send_payouts(batch)
+    except PayoutError:
+        give_up = [w for w in batch if w.get("attempts", 0) + 1 >= SETTLEMENT_MAX_ATTEMPTS]
+
+        def write_failure(session):
+            # Only touch rows this worker still holds; a stale claim may have been requeued and settled elsewhere
+            failed, failed_totals = [], defaultdict(float)
+            for w in give_up:
+                result = withdrawals_collection.update_one(
+                    {"id": w["id"], "batch_id": batch_id, "status": "processing"},
+                    {"$set": {"status": "failed", "processed_at": datetime.utcnow()}, "$inc": {"attempts": 1}},
+                    session=session
+                )
+                if result.modified_count:
+                    failed.append(w)
+                    failed_totals[w["user_email"]] += w["amount"]
+            withdrawals_collection.update_many(
+                {"batch_id": batch_id, "status": "processing"},
+                {"$set": {"status": "pending"}, "$inc": {"attempts": 1}},
+                session=session
+            )
+            if failed_totals:
+                adjust_balances(failed_totals, withdrawn=False, session=session)
+            return failed
+
+        for w in run_transaction(write_failure):
+            event_hub.publish(w["user_email"], "withdrawal", {"withdrawal_id": w["id"], "amount": w["amount"], "status": "failed"})
+        return 0
+
+    def write_settlement(session):
+        # Credit only rows this worker still holds, so a batch settled twice moves balances once
+        processed_at = datetime.utcnow()
+        settled, paid_totals = [], defaultdict(float)
+        for w in batch:
+            result = withdrawals_collection.update_one(
+                {"id": w["id"], "batch_id": batch_id, "status": "processing"},
+                {"$set": {"status": "completed", "processed_at": processed_at, "payout_id": payout_ids[w["id"]]}},
+                session=session
+            )
+            if result.modified_count:
+                settled.append(w)
+                paid_totals[w["user_email"]] += w["amount"]
+        if paid_totals:
+            adjust_balances(paid_totals, withdrawn=True, session=session)
+        return settled
+
+    settled = run_transaction(write_settlement)
+    for w in settled:
+        event_hub.publish(w["user_email"], "withdrawal", {"withdrawal_id": w["id"], "amount": w["amount"], "status": "completed"})
+    return len(settled)
+
+def migrate_withdrawal_balances():
+    """Backfill withdrawn and pending totals for users created before balance reservations"""
+    totals = defaultdict(lambda: defaultdict(float))
+    for row in withdrawals_collection.aggregate([
+        {"$group": {"_id": {"user_email": "$user_email", "status": "$status"}, "amount": {"$sum": "$amount"}}}
+    ]):
+        totals[row["_id"]["user_email"]][row["_id"]["status"]] += row["amount"]
+    for user in users_collection.find({"pending_withdrawal": {"$exists": False}}, {"_id": 0, "email": 1}):
+        user_totals = totals.get(user["email"], {})
+        users_collection.update_one(
+            {"email": user["email"], "pending_withdrawal": {"$exists": False}},
+            {"$set": {
+                "withdrawn": user_totals.get("completed", 0.0),
+                "pending_withdrawal": user_totals.get("pending", 0.0) + user_totals.get("processing", 0.0)
+            }}
+        )
+
+@app.on_event("startup")
+def start_settlement_worker():
+    migrate_withdrawal_balances()
+    start_periodic("withdrawal-settlement", SETTLEMENT_INTERVAL_SECONDS, settle_withdrawals)
+
+# Exports
+EXPORT_MEDIA_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+EXPORT_CHUNK_SIZE = 64 * 1024
+SALES_EXPORT_FIELDS = ["id", "created_at", "note_id", "note_title", "amount", "commission", "seller_amount", "payment_method", "status", "checkout_id"]
+WITHDRAWALS_EXPORT_FIELDS = ["id", "created_at", "amount", "payment_method", "status", "processed_at"]
+
+def export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+def stream_export(cursor, fields: List[str], export_format: str, extra=None):
+    """Encode cursor rows as CSV or NDJSON in chunks without materializing the result"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if export_format == "csv":
+        writer.writerow(fields)
+    for doc in cursor:
+        if extra:
+            doc.update(extra(doc))
+        row = [export_value(doc.get(field)) for field in fields]
+        if export_format == "csv":
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(fields, row)), default=str) + "\n")
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def export_response(name: str, cursor, fields: List[str], export_format: str, extra=None) -> StreamingResponse:
+    return StreamingResponse(
+        stream_export(cursor, fields, export_format, extra),
+        media_type=EXPORT_MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{export_format}"'}
+    )
+
+def naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """A datetime as naive UTC, the way created_at is stored; naive input is taken to be UTC already"""
+    if value is None or value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+def export_query(email_field: str, email: str, export_format: str, start: Optional[datetime], end: Optional[datetime]) -> dict:
+    if export_format not in EXPORT_MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail="Okänt exportformat")
+    start, end = naive_utc(start), naive_utc(end)
+    if start and end and start >= end:
+        raise HTTPException(status_code=400, detail="Ogiltigt datumintervall")
+    query = {email_field: email}
+    if start or end:
+        query["created_at"] = {}
+        if start:
+            query["created_at"]["$gte"] = start
+        if end:
+            query["created_at"]["$lt"] = end
+    return query
+
+# Recommendations
+RECOMMENDATION_NEIGHBORS = 20
+RECOMMENDATION_REBUILD_SECONDS = 3600
+RECOMMENDATION_MAX_BASKET = 200
+
+class CoPurchaseIndex:
+    """Sparse note co-purchase counts with precomputed top-k neighbor lists"""
+
+    def __init__(self):
+        self.buyers = defaultdict(int)  # note_id -> number of buyers
+        self.co_counts = defaultdict(lambda: defaultdict(int))  # note_id -> other note_id -> shared buyers
+        self.neighbors = {}  # note_id -> [(note_id, score)]
+        self.user_neighbors = {}  # buyer email -> [(note_id, score)], filled on first request
+        self._lock = threading.Lock()
+
+    def rebuild(self, baskets: List[List[str]]):
+        """Recount everything from each buyer's purchased notes"""
+        note_ids = sorted({note_id for basket in baskets for note_id in basket})
+        index = {note_id: i for i, note_id in enumerate(note_ids)}
+        n = len(note_ids)
+
+        # Every ordered pair of notes in a basket becomes one i * n + j cell of the sparse matrix
+        pair_cells, basket_cells = [], []
+        for basket in baskets:
+            idx = np.array([index[note_id] for note_id in basket[-RECOMMENDATION_MAX_BASKET:]], dtype=np.int64)
+            basket_cells.append(idx)
+            if len(idx) > 1:
+                rows, cols = np.meshgrid(idx, idx, indexing="ij")
+                off_diagonal = rows != cols
+                pair_cells.append(rows[off_diagonal] * n + cols[off_diagonal])
+        buyers = np.bincount(np.concatenate(basket_cells), minlength=n) if basket_cells else np.zeros(0, dtype=np.int64)
+        cells, counts = np.unique(np.concatenate(pair_cells), return_counts=True) if pair_cells else (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+        rows, cols = cells // n, cells % n
+        scores = counts / np.sqrt(buyers[rows] * buyers[cols])
+
+        # Sort by row, then score descending, and keep the first k cells of each row
+        order = np.lexsort((-scores, rows))
+        rows, cols, counts, scores = rows[order], cols[order], counts[order], scores[order]
+        row_starts = np.searchsorted(rows, np.arange(n))
+        rank = np.arange(len(rows)) - row_starts[rows]
+
+        co_counts = defaultdict(lambda: defaultdict(int))
+        for row, col, count in zip(rows.tolist(), cols.tolist(), counts.tolist()):
+            co_counts[note_ids[row]][note_ids[col]] = count
+        neighbors = defaultdict(list)
+        top = rank < RECOMMENDATION_NEIGHBORS
+        for row, col, score in zip(rows[top].tolist(), cols[top].tolist(), scores[top].tolist()):
+            neighbors[note_ids[row]].append((note_ids[col], score))
+
+        with self._lock:
+            self.buyers = defaultdict(int, {note_ids[i]: int(count) for i, count in enumerate(buyers)})
+            self.co_counts = co_counts
+            self.neighbors = dict(neighbors)
+            self.user_neighbors = {}
+
+    def _refresh_neighbors(self, note_id: str):
+        row = self.co_counts.get(note_id, {})
+        scored = (
+            (other, count / math.sqrt(self.buyers[note_id] * self.buyers[other]))
+            for other, count in row.items()
+        )
+        self.neighbors[note_id] = heapq.nlargest(RECOMMENDATION_NEIGHBORS, scored, key=lambda item: item[1])
+
+    def record_purchase(self, buyer_email: str, note_ids: List[str], previously_owned: List[str]):
+        """Count a purchase of note_ids by a buyer who already owned previously_owned"""
+        with self._lock:
+            basket = previously_owned[-RECOMMENDATION_MAX_BASKET:]
+            touched = set(note_ids)
+            for note_id in note_ids:
+                self.buyers[note_id] += 1
+                for other in basket:
+                    if other != note_id:
+                        self.co_counts[note_id][other] += 1
+                        self.co_counts[other][note_id] += 1
+                        touched.add(other)
+                basket = basket + [note_id]
+            # Scores are normalised by both notes' buyer counts, so every list holding a bought note moves too
+            for note_id in note_ids:
+                touched.update(self.co_counts.get(note_id, {}))
+            for note_id in touched:
+                self._refresh_neighbors(note_id)
+            self.user_neighbors.pop(buyer_email, None)
+
+    def for_note(self, note_id: str) -> List[tuple]:
+        with self._lock:
+            return list(self.neighbors.get(note_id, []))
+
+    def for_user(self, buyer_email: str, owned: List[str]) -> List[tuple]:
+        """Neighbors of everything a buyer owns, merged and cached until their next purchase"""
+        with self._lock:
+            cached = self.user_neighbors.get(buyer_email)
+            if cached is not None:
+                return cached
+            owned_set = set(owned)
+            scores = defaultdict(float)
+            for note_id in owned[-RECOMMENDATION_MAX_BASKET:]:
+                for other, score in self.neighbors.get(note_id, []):
+                    if other not in owned_set:
+                        scores[other] += score
+            ranked = heapq.nlargest(RECOMMENDATION_NEIGHBORS, scores.items(), key=lambda item: item[1])
+            self.user_neighbors[buyer_email] = ranked
+            return ranked
+
+co_purchases = CoPurchaseIndex()
+
+def rebuild_recommendations():
+    baskets = [
+        row["note_ids"] for row in payments_collection.aggregate([
+            {"$match": {"status": "completed"}},
+            {"$sort": {"created_at": 1}},
+            {"$group": {"_id": "$buyer_email", "note_ids": {"$push": "$note_id"}}}
+        ], allowDiskUse=True)
+    ]
+    co_purchases.rebuild(baskets)
+
+@app.on_event("startup")
+def start_recommendations():
+    rebuild_recommendations()
+    start_periodic("recommendation-rebuild", RECOMMENDATION_REBUILD_SECONDS, rebuild_recommendations)
+
+NOTE_CARD_PROJECTION = {"_id": 0, "file_path": 0, "is_deleted": 0, "comments": 0, "flashcards": 0, "quiz": 0}
+
+def ranked_note_cards(ranked: List[tuple], limit: Optional[int] = None) -> List[dict]:
+    """Active notes for ranked (note_id, score) pairs, in rank order with their score"""
+    notes = {
+        note["id"]: note for note in notes_collection.find(
+            {"id": {"$in": [note_id for note_id, _ in ranked]}, "is_deleted": False},
+            NOTE_CARD_PROJECTION
+        )
+    }
+    results = []
+    for note_id, score in ranked:
+        if note_id in notes:
+            notes[note_id]["score"] = score
+            results.append(counter_buffer.merge(notes[note_id]))
+    return results[:limit]
+
 # Routes
-@app.post("/api/register")
+@app.post("/api/register", dependencies=[Depends(auth_rate_limit), Depends(auth_limiter)])
 async def register(user: UserRegister):
     # Check if user already exists
     if users_collection.find_one({"email": user.email}):
@@ -192,13 +2202,14 @@ async def register(user: UserRegister):
     user_doc = {
         "id": str(uuid.uuid4()),
         "email": user.email,
-        "password": hash_password(user.password),
+        "password": await run_in_threadpool(hash_password, user.password),
         "name": user.name,
         "university": user.university,
         "created_at": datetime.utcnow(),
         "purchased_notes": [],
         "earnings": 0.0,
-        "withdrawn": 0.0
+        "withdrawn": 0.0,
+        "pending_withdrawal": 0.0
     }
     
     users_collection.insert_one(user_doc)
@@ -216,11 +2227,11 @@ async def register(user: UserRegister):
         }
     }
 
-@app.post("/api/login")
+@app.post("/api/login", dependencies=[Depends(auth_rate_limit), Depends(auth_limiter)])
 async def login(user: UserLogin):
     # Find user
     db_user = users_collection.find_one({"email": user.email})
-    if not db_user or not verify_password(user.password, db_user["password"]):
+    if not db_user or not await run_in_threadpool(verify_password, user.password, db_user["password"]):
         raise HTTPException(status_code=401, detail="Ogiltig e-post eller lösenord")
     
     # Create access token
@@ -247,9 +2258,9 @@ async def update_profile(update_data: UserUpdate, current_user: dict = Depends(g
     
     # Handle password change
     if update_data.current_password and update_data.new_password:
-        if not verify_password(update_data.current_password, current_user["password"]):
+        if not await run_in_threadpool(verify_password, update_data.current_password, current_user["password"]):
             raise HTTPException(status_code=400, detail="Felaktigt nuvarande lösenord")
-        update_fields["password"] = hash_password(update_data.new_password)
+        update_fields["password"] = await run_in_threadpool(hash_password, update_data.new_password)
     
     if update_fields:
         users_collection.update_one(
@@ -259,8 +2270,9 @@ async def update_profile(update_data: UserUpdate, current_user: dict = Depends(g
     
     return {"message": "Profil uppdaterad framgångsrikt"}
 
-@app.post("/api/upload-note")
+@app.post("/api/upload-note", dependencies=[Depends(upload_rate_limit), Depends(upload_limiter)])
 async def upload_note(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     title: str = Form(...),
     university: str = Form(...),
@@ -270,62 +2282,154 @@ async def upload_note(
     price: float = Form(0.0),
     current_user: dict = Depends(get_current_user)
 ):
-    # Validate file type
-    if not file.filename.endswith('.pdf'):
+    # Validate file name and type
+    original_filename = upload_filename(file.filename)
+    if not original_filename:
+        raise HTTPException(status_code=400, detail="Ogiltigt filnamn")
+    if not original_filename.endswith('.pdf'):
         raise HTTPException(status_code=400, detail="Endast PDF-filer är tillåtna")
     
     # Generate unique filename
     file_id = str(uuid.uuid4())
-    filename = f"{file_id}_{file.filename}"
-    file_path = f"/app/uploads/{filename}"
+    filename = f"{file_id}_{original_filename}"
+    
+    def progress(stage: str, **data):
+        event_hub.publish(current_user["email"], "upload.progress", {"upload_id": file_id, "filename": file.filename, "stage": stage, **data})
     
     # Save file
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    await run_in_threadpool(file_storage.save, filename, file.file)
+    progress("received")
     
     # Extract text from PDF
-    pdf_text = extract_pdf_text(file_path)
+    pdf_text = await run_in_threadpool(extract_pdf_text, await run_in_threadpool(file_storage.local_path, filename))
+    progress("extracted")
     
     # Generate AI content (mocked)
-    time.sleep(1)  # Simulate AI processing time
+    await asyncio.sleep(1)  # Simulate AI processing time
     summary = mock_ai_summarize(pdf_text)
     flashcards = mock_ai_flashcards(pdf_text)
     quiz = mock_ai_quiz(pdf_text)
+    minhash = await run_in_threadpool(minhash_signature, pdf_text)
+    body_terms = await run_in_threadpool(note_body_terms, pdf_text, summary)
     
     # Create note document
-    note_doc = {
-        "id": str(uuid.uuid4()),
-        "title": title,
-        "university": university,
-        "course_code": course_code,
-        "book_reference": book_reference,
-        "description": description,
-        "price": price,
-        "filename": filename,
-        "file_path": file_path,
-        "uploader_email": current_user["email"],
-        "uploader_name": current_user["name"],
-        "created_at": datetime.utcnow(),
-        "summary": summary,
-        "flashcards": flashcards,
-        "quiz": quiz,
-        "downloads": 0,
-        "rating": 0.0,
-        "rating_count": 0,
-        "comments": [],
-        "is_deleted": False
-    }
+    details = NoteUpload(
+        title=title,
+        university=university,
+        course_code=course_code,
+        book_reference=book_reference,
+        description=description,
+        price=price
+    )
+    note_doc = new_note_doc(
+        details, filename, current_user,
+        {"summary": summary, "flashcards": flashcards, "quiz": quiz, "minhash": minhash}
+    )
     
     notes_collection.insert_one(note_doc)
+    note_signatures_collection.insert_one({"note_id": note_doc["id"], "minhash": minhash})
+    note_terms_collection.insert_one({"note_id": note_doc["id"], "terms": list(body_terms), "counts": list(body_terms.values())})
+    text_index.set_body(note_doc["id"], body_terms)
+    index_note(note_doc)
+    dashboard_cache.invalidate(current_user["email"])
+    if minhash:
+        duplicate_index.add(note_doc["id"], minhash)
+    progress("completed", note_id=note_doc["id"])
+    
+    # Build the preview after responding so buyers never need the full file
+    background_tasks.add_task(generate_preview, note_doc["id"], filename, file_id)
     
     return {
         "message": "Anteckning uppladdad framgångsrikt",
         "note_id": note_doc["id"],
+        "possible_duplicates": note_doc["possible_duplicates"],
         "summary": summary,
         "flashcards": flashcards,
         "quiz": quiz
     }
 
+@app.post("/api/upload-notes", dependencies=[Depends(upload_rate_limit), Depends(upload_limiter)])
+async def bulk_upload_notes(
+    background_tasks: BackgroundTasks,
+    files: List[UploadFile] = File(...),
+    metadata: str = Form(...),
+    current_user: dict = Depends(get_current_user)
+):
+    # metadata is a JSON list of note fields per file, matched on "filename"
+    try:
+        entries = json.loads(metadata)
+        details_by_filename = {entry["filename"]: NoteUpload(**entry) for entry in entries}
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="Ogiltig metadata")
+    
+    saved = await run_in_threadpool(save_bulk_files, files)
+    for item in saved:
+        if "error" not in item and item["original_filename"] not in details_by_filename:
+            item["error"] = "Metadata saknas för filen"
+            await run_in_threadpool(file_storage.delete, item["filename"])
+    
+    def progress(item: dict, stage: str, **data):
+        event_hub.publish(current_user["email"], "upload.progress", {"upload_id": item["file_id"], "filename": item["original_filename"], "stage": stage, **data})
+    
+    # Extract text and generate AI content for every file in parallel
+    pending = [item for item in saved if "error" not in item]
+    
+    async def process(item: dict) -> dict:
+        progress(item, "received")
+        try:
+            result = await run_in_note_worker(process_note_file, item["file_path"])
+        except Exception:
+            progress(item, "failed")
+            raise
+        progress(item, "extracted")
+        return result
+    
+    generated = await asyncio.gather(*(process(item) for item in pending), return_exceptions=True)
+    
+    note_docs = []
+    for item, result in zip(pending, generated):
+        if isinstance(result, Exception):
+            item["error"] = "Bearbetning av filen misslyckades"
+            await run_in_threadpool(file_storage.delete, item["filename"])
+            continue
+        details = details_by_filename[item["original_filename"]]
+        item["note"] = new_note_doc(details, item["filename"], current_user, result)
+        note_docs.append(item["note"])
+        # Index right away so files within one batch are checked against each other too
+        if result["minhash"]:
+            duplicate_index.add(item["note"]["id"], result["minhash"])
+    
+    if note_docs:
+        notes_collection.insert_many(note_docs)
+        note_signatures_collection.insert_many([
+            {"note_id": item["note"]["id"], "minhash": result["minhash"]}
+            for item, result in zip(pending, generated) if "note" in item
+        ])
+        note_terms_collection.insert_many([
+            {"note_id": item["note"]["id"], "terms": list(result["body_terms"]), "counts": list(result["body_terms"].values())}
+            for item, result in zip(pending, generated) if "note" in item
+        ])
+    for item, result in zip(pending, generated):
+        if "note" in item:
+            text_index.set_body(item["note"]["id"], result["body_terms"])
+    dashboard_cache.invalidate(current_user["email"])
+    for item in saved:
+        if "note" in item:
+            index_note(item["note"])
+            progress(item, "completed", note_id=item["note"]["id"])
+            background_tasks.add_task(generate_preview, item["note"]["id"], item["filename"], item["file_id"])
+    
+    results = [
+        {"filename": item["original_filename"], "status": "created", "note_id": item["note"]["id"]}
+        if "note" in item else
+        {"filename": item["original_filename"], "status": "failed", "error": item["error"]}
+        for item in saved
+    ]
+    return {
+        "message": f"{len(note_docs)} av {len(results)} anteckningar uppladdade",
+        "results": results
+    }
+
 @app.put("/api/note/{note_id}")
 async def update_note(note_id: str, update_data: NoteUpdate, current_user: dict = Depends(get_current_user)):
     # Find note
@@ -357,6 +2461,9 @@ async def update_note(note_id: str, update_data: NoteUpdate, current_user: dict
             {"id": note_id},
             {"$set": update_fields}
         )
+        note.update(update_fields)
+        index_note(note)
+        dashboard_cache.invalidate(current_user["email"])
     
     return {"message": "Anteckning uppdaterad framgångsrikt"}
 
@@ -374,8 +2481,10 @@ async def delete_note(note_id: str, current_user: dict = Depends(get_current_use
     # Soft delete - mark as deleted but keep for existing buyers
     notes_collection.update_one(
         {"id": note_id},
-        {"$set": {"is_deleted": True}}
+        {"$set": {"is_deleted": True, "deleted_at": datetime.utcnow()}}
     )
+    unindex_note(note_id)
+    dashboard_cache.invalidate(current_user["email"])
     
     return {"message": "Anteckning borttagen framgångsrikt"}
 
@@ -385,10 +2494,17 @@ async def search_notes(
     course_code: Optional[str] = None,
     book_reference: Optional[str] = None,
     keyword: Optional[str] = None,
-    limit: int = 20
+    limit: int = 20,
+    facets: bool = False,
+    like: Optional[str] = None
 ):
     query = {"is_deleted": False}
     
+    # "More like this": restrict to the notes most similar to another note, ranked by similarity
+    similar = dict(text_index.similar(like, 200)) if like else None
+    if similar is not None:
+        query["id"] = {"$in": list(similar)}
+    
     if university:
         query["university"] = {"$regex": university, "$options": "i"}
     if course_code:
@@ -402,45 +2518,148 @@ async def search_notes(
             {"summary": {"$regex": keyword, "$options": "i"}}
         ]
     
-    notes = list(notes_collection.find(query).limit(limit))
+    if similar is not None:
+        notes = sorted(notes_collection.find(query), key=lambda note: similar[note["id"]], reverse=True)[:limit]
+        for note in notes:
+            note["score"] = similar[note["id"]]
+    else:
+        notes = list(notes_collection.find(query).limit(limit))
     
     # Remove file paths and format response
     for note in notes:
         note.pop("file_path", None)
         note.pop("_id", None)
         note.pop("is_deleted", None)
+        counter_buffer.merge(note)
     
-    return {"notes": notes}
+    if not facets:
+        return {"notes": notes}
+    
+    # Counts come from the facet index; only keyword, book and similarity filters need an id-only query
+    if keyword or book_reference or similar is not None:
+        matched = {n["id"] for n in notes_collection.find(query, {"_id": 0, "id": 1})}
+    else:
+        matched = None
+        if university:
+            matched = facet_index.match("university", university)
+        if course_code:
+            course_matches = facet_index.match("course_code", course_code)
+            matched = course_matches if matched is None else matched & course_matches
+    
+    facet_counts = facet_index.counts(matched)
+    total = len(matched) if matched is not None else len(facet_index.notes)
+    return {"notes": notes, "facets": facet_counts, "total": total}
+
+@app.get("/api/autocomplete")
+async def autocomplete(q: str, field: Optional[str] = None, limit: int = 8):
+    if field is not None and field not in AUTOCOMPLETE_FIELDS:
+        raise HTTPException(status_code=400, detail="Okänt fält")
+    
+    limit = max(1, min(limit, 20))
+    fields = [field] if field else AUTOCOMPLETE_FIELDS
+    return {"suggestions": {f: autocomplete_index.complete(f, q, limit) for f in fields}}
+
+@app.get("/api/leaderboard")
+async def get_leaderboard(
+    board: str = "trending",
+    university: Optional[str] = None,
+    course_code: Optional[str] = None,
+    limit: int = 10
+):
+    if board not in ("trending", "top-rated"):
+        raise HTTPException(status_code=400, detail="Okänd topplista")
+    
+    # Pick the narrowest board the filters describe
+    scopes = leaderboard_scopes({"university": university, "course_code": course_code})
+    if university and course_code:
+        scope = scopes[3]
+    elif course_code:
+        scope = scopes[2]
+    elif university:
+        scope = scopes[1]
+    else:
+        scope = scopes[0]
+    
+    ranked = leaderboards.top(board, scope, max(1, min(limit, 100)))
+    return {"board": board, "notes": ranked_note_cards(ranked)}
+
+@app.get("/api/note/{note_id}/related")
+async def get_related_notes(note_id: str, limit: int = 10):
+    limit = max(1, min(limit, 50))
+    # Ask for a few extra in case some were deleted since the last index update
+    return {"notes": ranked_note_cards(text_index.similar(note_id, limit + 5), limit)}
+
+@app.get("/api/note/{note_id}/recommendations")
+async def get_note_recommendations(note_id: str, limit: int = 10):
+    ranked = co_purchases.for_note(note_id)
+    return {"notes": ranked_note_cards(ranked, max(1, min(limit, RECOMMENDATION_NEIGHBORS)))}
+
+@app.get("/api/recommendations")
+async def get_recommendations(limit: int = 10, current_user: dict = Depends(get_current_user)):
+    ranked = co_purchases.for_user(current_user["email"], current_user.get("purchased_notes", []))
+    return {"notes": ranked_note_cards(ranked, max(1, min(limit, RECOMMENDATION_NEIGHBORS)))}
 
 @app.get("/api/note/{note_id}")
 async def get_note(note_id: str, current_user: dict = Depends(get_current_user)):
-    # For purchased notes, allow access even if deleted
-    note = notes_collection.find_one({"id": note_id})
+    # For purchased notes, allow access even if deleted or archived
+    note = find_note(note_id)
     if not note:
         raise HTTPException(status_code=404, detail="Anteckning hittades inte")
     
-    # If note is deleted, only allow access to owner and purchasers
-    if note.get("is_deleted", False):
-        if note["uploader_email"] != current_user["email"] and note_id not in current_user.get("purchased_notes", []):
-            raise HTTPException(status_code=404, detail="Anteckning hittades inte")
-    
-    # Check if user has access (is owner or has purchased)
-    has_access = (
-        note["uploader_email"] == current_user["email"] or
-        note_id in current_user.get("purchased_notes", []) or
-        note["price"] == 0.0
-    )
+    has_access = check_note_access(note, current_user)
+    counter_buffer.incr(note_id, "views")
+    counter_buffer.merge(note)
     
     # Remove sensitive data
     note.pop("_id", None)
     note.pop("is_deleted", None)
+    note.pop("cold_key", None)
     if not has_access:
         note.pop("file_path", None)
         note["access_required"] = True
+    else:
+        note["download_url"] = f"/api/note/{note_id}/download"
+    if note.get("preview_status") == "ready":
+        note["preview_url"] = f"/api/note/{note_id}/preview"
     
     return note
 
-@app.post("/api/purchase-note")
+@app.get("/api/note/{note_id}/download")
+async def download_note(note_id: str, current_user: dict = Depends(get_current_user)):
+    note = find_note(note_id, {"_id": 0, "id": 1, "uploader_email": 1, "price": 1, "is_deleted": 1, "filename": 1, "file_path": 1, "cold_key": 1})
+    if not note or not check_note_access(note, current_user):
+        raise HTTPException(status_code=404, detail="Anteckning hittades inte")
+    
+    counter_buffer.incr(note_id, "file_downloads")
+    download_name = note["filename"].split("_", 1)[-1]
+    if note.get("cold_key"):
+        def read_cold_file():
+            with cold_storage.open(note["cold_key"]) as compressed, gzip.GzipFile(fileobj=compressed, mode="rb") as cold_file:
+                while chunk := cold_file.read(64 * 1024):
+                    yield chunk
+        return StreamingResponse(
+            read_cold_file(),
+            media_type="application/pdf",
+            headers={"Content-Disposition": content_disposition(download_name)}
+        )
+    if not note.get("file_path") or not await run_in_threadpool(file_storage.exists, note["filename"]):
+        raise HTTPException(status_code=404, detail="Filen hittades inte")
+    return file_storage.download_response(note["filename"], download_name)
+
+@app.get("/api/note/{note_id}/preview")
+async def get_note_preview(note_id: str):
+    note = notes_collection.find_one({"id": note_id, "is_deleted": False}, {"_id": 0, "preview_filename": 1})
+    if not note or not note.get("preview_filename"):
+        raise HTTPException(status_code=404, detail="Förhandsvisning hittades inte")
+    
+    # Preview files are written once per upload, so clients and proxies may keep them
+    return FileResponse(
+        await run_in_threadpool(file_storage.local_path, preview_key(note["preview_filename"])),
+        media_type="application/pdf",
+        headers={"Cache-Control": "public, max-age=31536000, immutable"}
+    )
+
+@app.post("/api/purchase-note", dependencies=[Depends(purchase_rate_limit), Depends(purchase_limiter)])
 async def purchase_note(purchase: NoteAccess, current_user: dict = Depends(get_current_user)):
     note = notes_collection.find_one({"id": purchase.note_id, "is_deleted": False})
     if not note:
@@ -451,7 +2670,7 @@ async def purchase_note(purchase: NoteAccess, current_user: dict = Depends(get_c
         raise HTTPException(status_code=400, detail="Anteckning redan köpt")
     
     # Mock PayPal payment processing
-    time.sleep(2)  # Simulate payment processing
+    await asyncio.sleep(2)  # Simulate payment processing
     
     # Create payment record
     payment_doc = {
@@ -482,10 +2701,13 @@ async def purchase_note(purchase: NoteAccess, current_user: dict = Depends(get_c
     )
     
     # Update note download count
-    notes_collection.update_one(
-        {"id": purchase.note_id},
-        {"$inc": {"downloads": 1}}
-    )
+    counter_buffer.incr(purchase.note_id, "downloads")
+    leaderboards.record(purchase.note_id, "purchase", when=payment_doc["created_at"])
+    leaderboards.record(purchase.note_id, "download", when=payment_doc["created_at"])
+    co_purchases.record_purchase(current_user["email"], [purchase.note_id], current_user.get("purchased_notes", []))
+    event_hub.publish(current_user["email"], "purchase", {"note_ids": [purchase.note_id], "payment_ids": [payment_doc["id"]]})
+    dashboard_cache.invalidate(note["uploader_email"])
+    event_hub.publish(note["uploader_email"], "sale", {"note_id": purchase.note_id, "amount": payment_doc["seller_amount"]})
     
     return {
         "message": "Köp framgångsrikt",
@@ -493,6 +2715,82 @@ async def purchase_note(purchase: NoteAccess, current_user: dict = Depends(get_c
         "amount": note["price"]
     }
 
+@app.post("/api/checkout", dependencies=[Depends(purchase_rate_limit), Depends(purchase_limiter)])
+async def checkout_cart(cart: CartCheckout, current_user: dict = Depends(get_current_user)):
+    note_ids = list(dict.fromkeys(cart.note_ids))
+    if not note_ids:
+        raise HTTPException(status_code=400, detail="Varukorgen är tom")
+    
+    # Validate the whole cart in one query
+    notes = list(notes_collection.find(
+        {"id": {"$in": note_ids}, "is_deleted": False},
+        {"_id": 0, "id": 1, "uploader_email": 1, "price": 1}
+    ))
+    if len(notes) != len(note_ids):
+        raise HTTPException(status_code=404, detail="Anteckning hittades inte")
+    if set(note_ids) & set(current_user.get("purchased_notes", [])):
+        raise HTTPException(status_code=400, detail="Anteckning redan köpt")
+    
+    # Mock PayPal payment processing, once for the whole cart
+    await asyncio.sleep(2)
+    
+    checkout_id = str(uuid.uuid4())
+    now = datetime.utcnow()
+    payment_docs = [
+        {
+            "id": str(uuid.uuid4()),
+            "checkout_id": checkout_id,
+            "buyer_email": current_user["email"],
+            "seller_email": note["uploader_email"],
+            "note_id": note["id"],
+            "amount": note["price"],
+            "commission": note["price"] * 0.3,  # 30% platform commission
+            "seller_amount": note["price"] * 0.7,  # 70% to seller
+            "payment_method": cart.payment_method,
+            "status": "completed",
+            "created_at": now
+        }
+        for note in notes
+    ]
+    seller_earnings = defaultdict(float)
+    for payment in payment_docs:
+        seller_earnings[payment["seller_email"]] += payment["seller_amount"]
+    
+    def write_checkout(session):
+        # Guard on the buyer document so concurrent checkouts can't buy a note twice
+        buyer = users_collection.update_one(
+            {"email": current_user["email"], "purchased_notes": {"$nin": note_ids}},
+            {"$push": {"purchased_notes": {"$each": note_ids}}},
+            session=session
+        )
+        if buyer.modified_count == 0:
+            raise HTTPException(status_code=400, detail="Anteckning redan köpt")
+        payments_collection.insert_many(payment_docs, session=session)
+        users_collection.bulk_write(
+            [UpdateOne({"email": seller}, {"$inc": {"earnings": amount}}) for seller, amount in seller_earnings.items()],
+            session=session
+        )
+    
+    run_transaction(write_checkout)
+    
+    for note_id in note_ids:
+        counter_buffer.incr(note_id, "downloads")
+        leaderboards.record(note_id, "purchase", when=now)
+        leaderboards.record(note_id, "download", when=now)
+    co_purchases.record_purchase(current_user["email"], note_ids, current_user.get("purchased_notes", []))
+    event_hub.publish(current_user["email"], "purchase", {"note_ids": note_ids, "payment_ids": [payment["id"] for payment in payment_docs]})
+    for seller in seller_earnings:
+        dashboard_cache.invalidate(seller)
+    for payment in payment_docs:
+        event_hub.publish(payment["seller_email"], "sale", {"note_id": payment["note_id"], "amount": payment["seller_amount"]})
+    
+    return {
+        "message": "Köp framgångsrikt",
+        "checkout_id": checkout_id,
+        "payment_ids": [payment["id"] for payment in payment_docs],
+        "amount": sum(payment["amount"] for payment in payment_docs)
+    }
+
 @app.post("/api/comment-note")
 async def comment_note(comment: NoteComment, current_user: dict = Depends(get_current_user)):
     note = notes_collection.find_one({"id": comment.note_id})
@@ -529,23 +2827,100 @@ async def comment_note(comment: NoteComment, current_user: dict = Depends(get_cu
             }
         }
     )
+    leaderboards.record(comment.note_id, "rating", rating_event_value(comment.rating), when=comment_doc["created_at"])
+    leaderboards.rate(comment.note_id, avg_rating, len(ratings))
+    if not updated_note.get("is_deleted", False):
+        updated_note.update({"rating": avg_rating, "rating_count": len(ratings)})
+        facet_index.add(updated_note)
+    dashboard_cache.invalidate(note["uploader_email"])
+    if note["uploader_email"] != current_user["email"]:
+        event_hub.publish(note["uploader_email"], "comment", {
+            "note_id": comment.note_id,
+            "comment_id": comment_doc["id"],
+            "user_name": comment_doc["user_name"],
+            "rating": comment.rating
+        })
     
     return {"message": "Kommentar tillagd framgångsrikt"}
 
+@app.get("/api/events")
+async def event_stream(
+    token: Optional[str] = None,
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)
+):
+    # EventSource can't send headers, so the token may also come as a query parameter
+    if credentials:
+        token = credentials.credentials
+    if not token:
+        raise HTTPException(status_code=401, detail="Ogiltiga autentiseringsuppgifter")
+    email = (await run_in_threadpool(user_from_token, token))["email"]
+    queue = event_hub.subscribe(email)
+    
+    async def stream():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), EVENT_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+        finally:
+            event_hub.unsubscribe(email, queue)
+    
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @app.get("/api/my-notes")
 async def get_my_notes(current_user: dict = Depends(get_current_user)):
-    # Include both active and deleted notes for owner
+    # Include both active and deleted notes for owner, archived ones too
     notes = list(notes_collection.find({"uploader_email": current_user["email"]}))
+    active_ids = {note["id"] for note in notes}
+    notes += [
+        note for note in notes_archive_collection.find({"uploader_email": current_user["email"]}, {"cold_key": 0})
+        if note["id"] not in active_ids  # Briefly in both while the archiver moves it
+    ]
     for note in notes:
         note.pop("_id", None)
         note.pop("file_path", None)
+        counter_buffer.merge(note)
     return {"notes": notes}
 
+def with_pending_counts(page: dict) -> dict:
+    # Copies, so the cached page keeps the stored counts
+    return {**page, "notes": [counter_buffer.merge(dict(note)) for note in page["notes"]]}
+
+@app.get("/api/seller-dashboard")
+async def get_seller_dashboard(
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    include_deleted: bool = False,
+    current_user: dict = Depends(get_current_user)
+):
+    limit = max(1, min(limit, 100))
+    page_key = (limit, cursor, include_deleted)
+    page = dashboard_cache.get(current_user["email"], page_key)
+    if page is not None:
+        return with_pending_counts(page)
+    
+    rows = list(notes_collection.aggregate(seller_dashboard_pipeline(current_user["email"], limit, cursor, include_deleted)))
+    page = dashboard_page(rows, limit, current_user.get("earnings", 0.0))
+    dashboard_cache.put(current_user["email"], page_key, page)
+    return with_pending_counts(page)
+
 @app.get("/api/my-purchases")
 async def get_my_purchases(current_user: dict = Depends(get_current_user)):
     purchased_note_ids = current_user.get("purchased_notes", [])
-    # Allow access to purchased notes even if deleted
+    # Allow access to purchased notes even if deleted or archived
     notes = list(notes_collection.find({"id": {"$in": purchased_note_ids}}))
+    archived_ids = set(purchased_note_ids) - {note["id"] for note in notes}
+    if archived_ids:
+        notes += list(notes_archive_collection.find(
+            {"id": {"$in": list(archived_ids)}},
+            {"cold_key": 0}
+        ))
     
     # Sort by purchase date (get from payments collection)
     payments = list(payments_collection.find(
@@ -560,6 +2935,7 @@ async def get_my_purchases(current_user: dict = Depends(get_current_user)):
         note.pop("_id", None)
         note.pop("is_deleted", None)
         note["purchase_date"] = purchase_dates.get(note["id"], datetime.utcnow())
+        counter_buffer.merge(note)
     
     # Sort by purchase date (most recent first)
     notes.sort(key=lambda x: x["purchase_date"], reverse=True)
@@ -568,9 +2944,10 @@ async def get_my_purchases(current_user: dict = Depends(get_current_user)):
 
 @app.get("/api/profile")
 async def get_profile(current_user: dict = Depends(get_current_user)):
-    # Get withdrawal history
-    withdrawals = list(withdrawals_collection.find({"user_email": current_user["email"]}))
-    total_withdrawn = sum(w["amount"] for w in withdrawals if w["status"] == "completed")
+    # Withdrawal totals are kept on the user by the withdraw route and the settlement worker
+    total_withdrawn = current_user.get("withdrawn", 0.0)
+    pending_withdrawal = current_user.get("pending_withdrawal", 0.0)
+    available_balance = current_user.get("earnings", 0.0) - total_withdrawn - pending_withdrawal
     
     user_data = {
         "email": current_user["email"],
@@ -578,50 +2955,61 @@ async def get_profile(current_user: dict = Depends(get_current_user)):
         "university": current_user["university"],
         "earnings": current_user.get("earnings", 0.0),
         "withdrawn": total_withdrawn,
-        "available_balance": current_user.get("earnings", 0.0) - total_withdrawn,
-        "notes_uploaded": notes_collection.count_documents({"uploader_email": current_user["email"]}),
+        "pending_withdrawal": pending_withdrawal,
+        "available_balance": available_balance,
+        "notes_uploaded": notes_collection.count_documents({"uploader_email": current_user["email"]})
+            + notes_archive_collection.count_documents({"uploader_email": current_user["email"]}),
         "notes_purchased": len(current_user.get("purchased_notes", [])),
-        "can_withdraw": (current_user.get("earnings", 0.0) - total_withdrawn) >= 150.0
+        "can_withdraw": available_balance >= MIN_WITHDRAWAL_AMOUNT
     }
     return user_data
 
 @app.post("/api/withdraw")
 async def request_withdrawal(withdrawal: WithdrawalRequest, current_user: dict = Depends(get_current_user)):
-    # Check available balance
-    withdrawals = list(withdrawals_collection.find({"user_email": current_user["email"]}))
-    total_withdrawn = sum(w["amount"] for w in withdrawals if w["status"] == "completed")
-    available_balance = current_user.get("earnings", 0.0) - total_withdrawn
-    
-    if withdrawal.amount > available_balance:
-        raise HTTPException(status_code=400, detail="Otillräckligt saldo")
-    
-    if withdrawal.amount < 150.0:
+    if withdrawal.amount < MIN_WITHDRAWAL_AMOUNT:
         raise HTTPException(status_code=400, detail="Minsta uttagsbelopp är 150 kr")
     
-    # Create withdrawal request
+    # Queue the withdrawal; the settlement worker pays it out in a batch
     withdrawal_doc = {
         "id": str(uuid.uuid4()),
         "user_email": current_user["email"],
         "amount": withdrawal.amount,
         "payment_method": withdrawal.payment_method,
         "status": "pending",
+        "attempts": 0,
         "created_at": datetime.utcnow(),
         "processed_at": None
     }
     
-    withdrawals_collection.insert_one(withdrawal_doc)
+    # Reserve the amount only if the available balance covers it, together with the queued withdrawal
+    available_balance = {"$subtract": [
+        {"$ifNull": ["$earnings", 0.0]},
+        {"$add": [{"$ifNull": ["$withdrawn", 0.0]}, {"$ifNull": ["$pending_withdrawal", 0.0]}]}
+    ]}
     
-    # For demo purposes, immediately approve the withdrawal
-    withdrawals_collection.update_one(
-        {"id": withdrawal_doc["id"]},
-        {"$set": {"status": "completed", "processed_at": datetime.utcnow()}}
-    )
+    def write_withdrawal(session):
+        reserved = users_collection.update_one(
+            {"email": current_user["email"], "$expr": {"$gte": [available_balance, withdrawal.amount]}},
+            {"$inc": {"pending_withdrawal": withdrawal.amount}},
+            session=session
+        )
+        if reserved.modified_count == 0:
+            raise HTTPException(status_code=400, detail="Otillräckligt saldo")
+        try:
+            withdrawals_collection.insert_one(withdrawal_doc, session=session)
+        except pymongo.errors.PyMongoError:
+            if session is None:
+                # No transaction to roll back on a standalone server, so release the reservation by hand
+                users_collection.update_one({"email": current_user["email"]}, {"$inc": {"pending_withdrawal": -withdrawal.amount}})
+            raise
+    
+    run_transaction(write_withdrawal)
     
     return {
         "message": "Uttagsförfrågan skickad framgångsrikt",
         "withdrawal_id": withdrawal_doc["id"],
         "amount": withdrawal.amount,
-        "status": "completed"
+        "status": "pending"
     }
 
 @app.get("/api/withdrawals")
@@ -635,6 +3023,39 @@ async def get_withdrawals(current_user: dict = Depends(get_current_user)):
     
     return {"withdrawals": withdrawals}
 
+@app.get("/api/export/sales")
+async def export_sales(
+    format: str = "csv",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    query = export_query("seller_email", current_user["email"], format, start, end)
+    
+    # Seller note titles are few compared to sales, so look them up once
+    titles = {}
+    for collection in (notes_collection, notes_archive_collection):
+        for note in collection.find({"uploader_email": current_user["email"]}, {"_id": 0, "id": 1, "title": 1}):
+            titles[note["id"]] = note["title"]
+    
+    cursor = payments_collection.find(query, {"_id": 0, "buyer_email": 0}).sort("created_at", 1).batch_size(1000)
+    return export_response("sales", cursor, SALES_EXPORT_FIELDS, format, lambda payment: {"note_title": titles.get(payment["note_id"])})
+
+@app.get("/api/export/withdrawals")
+async def export_withdrawals(
+    format: str = "csv",
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    current_user: dict = Depends(get_current_user)
+):
+    query = export_query("user_email", current_user["email"], format, start, end)
+    cursor = withdrawals_collection.find(query, {"_id": 0}).sort("created_at", 1).batch_size(1000)
+    return export_response("withdrawals", cursor, WITHDRAWALS_EXPORT_FIELDS, format)
+
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
+    if sys.argv[1:] == ["scan-duplicates"]:
+        # Batch job: python server.py scan-duplicates
+        print(f"{scan_duplicates()} anteckningar flaggade som möjliga dubbletter")
+    else:
+        import uvicorn
+        uvicorn.run(app, host="0.0.0.0", port=8001)
\ No newline at end of file
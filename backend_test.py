@@ -304,6 +304,35 @@ class StudentPlatformTester:
         
         return success
 
+    def test_checkout_double_buy(self):
+        """Test that a note cannot be bought twice through checkout"""
+        if not self.uploaded_note_id:
+            self.log("❌ No uploaded note ID for checkout test")
+            return False
+            
+        cart = {"note_ids": [self.uploaded_note_id], "payment_method": "paypal"}
+        
+        success1, response1 = self.run_test(
+            "Checkout Cart",
+            "POST",
+            "api/checkout",
+            200,
+            data=cart
+        )
+        
+        success2, response2 = self.run_test(
+            "Checkout Already Bought Note",
+            "POST",
+            "api/checkout",
+            400,
+            data=cart
+        )
+        
+        if success1:
+            self.log(f"   Checkout ID: {response1.get('checkout_id', 'N/A')}")
+            
+        return success1 and success2
+
     def test_user_profile(self):
         """Test getting user profile"""
         if not self.token:
@@ -363,6 +392,43 @@ class StudentPlatformTester:
             
         return False
 
+    def test_withdrawal_balances(self):
+        """Test that withdrawals beyond the available balance are rejected"""
+        if not self.token:
+            self.log("❌ No authentication token for withdrawal test")
+            return False
+            
+        success1, response1 = self.run_test(
+            "Withdrawal Below Minimum",
+            "POST",
+            "api/withdraw",
+            400,
+            data={"amount": 100.0, "payment_method": "swish"}
+        )
+        
+        # A fresh test user has no earnings, so nothing can be reserved
+        success2, response2 = self.run_test(
+            "Withdrawal Over Balance",
+            "POST",
+            "api/withdraw",
+            400,
+            data={"amount": 150.0, "payment_method": "swish"}
+        )
+        
+        success3, response3 = self.run_test(
+            "Balances After Rejected Withdrawal",
+            "GET",
+            "api/profile",
+            200
+        )
+        
+        if success3:
+            self.log(f"   Pending withdrawal: {response3.get('pending_withdrawal', 'N/A')} SEK")
+            self.log(f"   Available balance: {response3.get('available_balance', 'N/A')} SEK")
+            success3 = response3.get('pending_withdrawal') == 0 and response3.get('available_balance') == response3.get('earnings')
+            
+        return success1 and success2 and success3
+
     def test_unauthorized_access(self):
         """Test accessing protected endpoints without token"""
         # Temporarily remove token
@@ -398,12 +464,14 @@ class StudentPlatformTester:
         self.test_search_notes()
         self.test_get_note_details()
         self.test_note_comment()
+        self.test_checkout_double_buy()
         
         # User Profile Tests
         self.log("\n👤 User Profile Tests")
         self.test_user_profile()
         self.test_my_notes()
         self.test_my_purchases()
+        self.test_withdrawal_balances()
         
         # Print final results
         self.log(f"\n📊 Test Results: {self.tests_passed}/{self.tests_run} tests passed")
@@ -0,0 +1,54 @@
+import os
+import sys
+
+import mongomock
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend"))
+
+import server  # noqa: E402
+
+COLLECTIONS = [
+    "users_collection",
+    "notes_collection",
+    "payments_collection",
+    "withdrawals_collection",
+    "notes_archive_collection",
+    "note_signatures_collection",
+    "note_terms_collection",
+]
+
+
+@pytest.fixture(autouse=True)
+def db(monkeypatch):
+    """Point every collection at a fresh in-memory database"""
+    database = mongomock.MongoClient()["student_platform"]
+    for name in COLLECTIONS:
+        monkeypatch.setattr(server, name, database[getattr(server, name).name])
+    # mongomock has no sessions, like a standalone server
+    monkeypatch.setattr(server, "transactions_supported", False)
+    return database
+
+
+@pytest.fixture
+def client():
+    return TestClient(server.app)
+
+
+@pytest.fixture
+def make_user(db):
+    def make(email, earnings=0.0, **fields):
+        server.users_collection.insert_one({
+            "email": email,
+            "password": server.hash_password("TestPass123!"),
+            "name": email.split("@")[0],
+            "university": "Test University",
+            "earnings": earnings,
+            "purchased_notes": [],
+            "withdrawn": 0.0,
+            "pending_withdrawal": 0.0,
+            **fields,
+        })
+        return {"Authorization": f"Bearer {server.create_access_token({'sub': email})}"}
+    return make
@@ -0,0 +1,35 @@
+from datetime import datetime, timedelta
+
+import server
+
+
+def test_owner_still_sees_archived_notes(client, make_user):
+    headers = make_user("seller@example.com")
+    now = datetime.utcnow()
+    server.notes_collection.insert_one({"id": "active", "uploader_email": "seller@example.com", "is_deleted": False, "created_at": now})
+    server.notes_archive_collection.insert_many([
+        {"id": "archived", "uploader_email": "seller@example.com", "is_deleted": True, "created_at": now - timedelta(days=90), "cold_key": "x.gz"},
+        {"id": "other", "uploader_email": "other@example.com", "is_deleted": True, "created_at": now},
+    ])
+
+    notes = client.get("/api/my-notes", headers=headers).json()["notes"]
+    assert sorted(note["id"] for note in notes) == ["active", "archived"]
+    assert all("cold_key" not in note for note in notes)
+    assert client.get("/api/profile", headers=headers).json()["notes_uploaded"] == 2
+
+
+def test_note_mid_archive_is_listed_once(client, make_user):
+    headers = make_user("seller@example.com")
+    note = {"id": "moving", "uploader_email": "seller@example.com", "is_deleted": True, "created_at": datetime.utcnow()}
+    server.notes_collection.insert_one(dict(note))
+    server.notes_archive_collection.insert_one(dict(note))
+
+    notes = client.get("/api/my-notes", headers=headers).json()["notes"]
+    assert [note["id"] for note in notes] == ["moving"]
+
+
+def test_dashboard_reads_archive_only_with_deleted_notes():
+    with_deleted = server.seller_dashboard_pipeline("seller@example.com", 20, None, True)
+    without_deleted = server.seller_dashboard_pipeline("seller@example.com", 20, None, False)
+    assert with_deleted[1]["$unionWith"]["coll"] == server.notes_archive_collection.name
+    assert all("$unionWith" not in stage for stage in without_deleted)
@@ -0,0 +1,92 @@
+from datetime import datetime
+
+import pytest
+
+import server
+
+
+@pytest.fixture(autouse=True)
+def no_payment_delay(monkeypatch):
+    async def sleep(seconds):
+        pass
+    monkeypatch.setattr(server.asyncio, "sleep", sleep)
+
+
+@pytest.fixture
+def make_note(db):
+    def make(note_id, price, uploader_email="seller@example.com", **fields):
+        server.notes_collection.insert_one({
+            "id": note_id,
+            "title": f"Note {note_id}",
+            "university": "Test University",
+            "course_code": "CS101",
+            "price": price,
+            "uploader_email": uploader_email,
+            "created_at": datetime.utcnow(),
+            "downloads": 0,
+            "is_deleted": False,
+            **fields,
+        })
+        return note_id
+    return make
+
+
+def test_checkout_pays_every_seller(client, make_user, make_note):
+    make_user("seller@example.com")
+    make_user("other@example.com")
+    headers = make_user("buyer@example.com")
+    make_note("a", 100.0)
+    make_note("b", 50.0)
+    make_note("c", 200.0, uploader_email="other@example.com")
+
+    response = client.post("/api/checkout", headers=headers, json={"note_ids": ["a", "b", "c", "a"]})
+    assert response.status_code == 200
+
+    payments = list(server.payments_collection.find({"checkout_id": response.json()["checkout_id"]}))
+    assert sorted(p["note_id"] for p in payments) == ["a", "b", "c"]
+    assert server.users_collection.find_one({"email": "seller@example.com"})["earnings"] == pytest.approx(105.0)
+    assert server.users_collection.find_one({"email": "other@example.com"})["earnings"] == pytest.approx(140.0)
+    assert sorted(server.users_collection.find_one({"email": "buyer@example.com"})["purchased_notes"]) == ["a", "b", "c"]
+
+
+def test_checkout_rejects_notes_already_bought(client, make_user, make_note):
+    make_user("seller@example.com")
+    headers = make_user("buyer@example.com")
+    make_note("a", 100.0)
+    make_note("b", 50.0)
+
+    assert client.post("/api/checkout", headers=headers, json={"note_ids": ["a"]}).status_code == 200
+    response = client.post("/api/checkout", headers=headers, json={"note_ids": ["a", "b"]})
+    assert response.status_code == 400
+
+    # Nothing from the rejected cart was charged or granted
+    assert server.payments_collection.count_documents({}) == 1
+    assert server.users_collection.find_one({"email": "buyer@example.com"})["purchased_notes"] == ["a"]
+    assert server.users_collection.find_one({"email": "seller@example.com"})["earnings"] == pytest.approx(70.0)
+
+
+def test_checkout_guard_catches_concurrent_purchase(client, make_user, make_note, monkeypatch):
+    make_user("seller@example.com")
+    headers = make_user("buyer@example.com")
+    make_note("a", 100.0)
+
+    # Another checkout buys the note after this one validated the cart but before it writes
+    async def concurrent_purchase(seconds):
+        server.users_collection.update_one({"email": "buyer@example.com"}, {"$push": {"purchased_notes": "a"}})
+    monkeypatch.setattr(server.asyncio, "sleep", concurrent_purchase)
+
+    response = client.post("/api/checkout", headers=headers, json={"note_ids": ["a"]})
+    assert response.status_code == 400
+    assert server.payments_collection.count_documents({}) == 0
+    assert server.users_collection.find_one({"email": "buyer@example.com"})["purchased_notes"] == ["a"]
+
+
+def test_checkout_rejects_missing_or_deleted_notes(client, make_user, make_note):
+    make_user("seller@example.com")
+    headers = make_user("buyer@example.com")
+    make_note("a", 100.0)
+    make_note("gone", 100.0, is_deleted=True)
+
+    assert client.post("/api/checkout", headers=headers, json={"note_ids": ["a", "gone"]}).status_code == 404
+    assert client.post("/api/checkout", headers=headers, json={"note_ids": []}).status_code == 400
+    assert server.payments_collection.count_documents({}) == 0
@@ -0,0 +1,99 @@
+import threading
+
+import server
+
+
+def test_pending_counts_are_merged_and_flushed(db):
+    server.notes_collection.insert_one({"id": "a", "downloads": 2, "views": 0})
+    buffer = server.CounterBuffer()
+    buffer.incr("a", "downloads")
+    buffer.incr("a", "views", 3)
+
+    note = buffer.merge(server.notes_collection.find_one({"id": "a"}, {"_id": 0}))
+    assert (note["downloads"], note["views"]) == (3, 3)
+
+    assert buffer.flush() == ["a"]
+    stored = server.notes_collection.find_one({"id": "a"}, {"_id": 0})
+    assert (stored["downloads"], stored["views"]) == (3, 3)
+    # Nothing pending, so merging no longer adds anything
+    assert buffer.merge(dict(stored)) == stored
+    assert buffer.flush() == []
+
+
+def test_failed_flush_keeps_deltas(db, monkeypatch):
+    server.notes_collection.insert_one({"id": "a", "downloads": 0})
+    buffer = server.CounterBuffer()
+    buffer.incr("a", "downloads")
+
+    def fail(*args, **kwargs):
+        raise server.pymongo.errors.AutoReconnect("connection lost")
+
+    monkeypatch.setattr(server.notes_collection, "bulk_write", fail)
+    try:
+        buffer.flush()
+    except server.pymongo.errors.AutoReconnect:
+        pass
+    monkeypatch.undo()
+    assert buffer.merge({"id": "a", "downloads": 0})["downloads"] == 1
+
+
+def test_concurrent_flushes_do_not_drop_in_flight_deltas(db, monkeypatch):
+    server.notes_collection.insert_one({"id": "a", "downloads": 0})
+    buffer = server.CounterBuffer()
+    buffer.incr("a", "downloads")
+    writing, release = threading.Event(), threading.Event()
+    bulk_write = server.notes_collection.bulk_write
+
+    def slow_bulk_write(*args, **kwargs):
+        writing.set()
+        release.wait(5)
+        return bulk_write(*args, **kwargs)
+
+    monkeypatch.setattr(server.notes_collection, "bulk_write", slow_bulk_write)
+    first = threading.Thread(target=buffer.flush)
+    first.start()
+    writing.wait(5)
+
+    # A second flush, e.g. from the shutdown handler, waits for the first
+    buffer.incr("a", "downloads")
+    second = threading.Thread(target=buffer.flush)
+    second.start()
+    second.join(0.2)
+    assert second.is_alive()
+    assert buffer.merge({"id": "a", "downloads": 0})["downloads"] == 2
+
+    release.set()
+    first.join(5)
+    second.join(5)
+    assert server.notes_collection.find_one({"id": "a"})["downloads"] == 2
+    assert buffer.merge({"id": "a", "downloads": 2})["downloads"] == 2
+
+
+def test_flush_drops_cached_dashboard_pages(db, monkeypatch):
+    server.notes_collection.insert_one({"id": "a", "downloads": 0})
+    buffer, cache = server.CounterBuffer(), server.DashboardCache()
+    monkeypatch.setattr(server, "counter_buffer", buffer)
+    monkeypatch.setattr(server, "dashboard_cache", cache)
+    page = {"earnings": 0.0, "notes": [{"id": "a", "downloads": 0}], "next_cursor": None}
+    cache.put("seller@example.com", (20, None, False), page)
+
+    buffer.incr("a", "downloads")
+    assert server.with_pending_counts(page)["notes"][0]["downloads"] == 1
+    assert page["notes"][0]["downloads"] == 0  # The cached page itself is left alone
+
+    server.flush_counter_buffer()
+    assert cache.get("seller@example.com", (20, None, False)) is None
+
+
+def test_note_lists_include_pending_counts(client, make_user, monkeypatch):
+    buffer = server.CounterBuffer()
+    monkeypatch.setattr(server, "counter_buffer", buffer)
+    server.notes_collection.insert_one({"id": "a", "uploader_email": "seller@example.com", "is_deleted": False, "downloads": 2, "views": 5})
+    seller = make_user("seller@example.com")
+    buyer = make_user("buyer@example.com", purchased_notes=["a"])
+    buffer.incr("a", "downloads")
+    buffer.incr("a", "views", 2)
+
+    for path, headers in (("/api/my-notes", seller), ("/api/my-purchases", buyer)):
+        note = client.get(path, headers=headers).json()["notes"][0]
+        assert (note["downloads"], note["views"]) == (3, 7)
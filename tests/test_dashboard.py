@@ -0,0 +1,128 @@
+import os
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from pymongo import MongoClient
+
+import server
+
+SELLER = "seller@example.com"
+
+
+def insert_notes(count, created_at=None):
+    start = datetime(2026, 1, 1)
+    server.notes_collection.insert_many([
+        {
+            "id": f"note-{i:02d}",
+            "uploader_email": SELLER,
+            "is_deleted": False,
+            "created_at": created_at or start + timedelta(minutes=i),
+        }
+        for i in range(count)
+    ])
+
+
+def page_ids(limit, cursor=None):
+    rows = list(server.notes_collection.aggregate(server.dashboard_notes_stages(SELLER, limit, cursor, False)))
+    page = server.dashboard_page(rows, limit, 0.0)
+    return [note["id"] for note in page["notes"]], page["next_cursor"]
+
+
+def walk_pages(limit):
+    seen, cursor = [], None
+    while True:
+        ids, cursor = page_ids(limit, cursor)
+        seen.append(ids)
+        if cursor is None:
+            return seen
+
+
+def test_cursor_pages_cover_every_note_newest_first():
+    insert_notes(7)
+
+    pages = walk_pages(3)
+    assert [len(ids) for ids in pages] == [3, 3, 1]
+    assert sum(pages, []) == [f"note-{i:02d}" for i in reversed(range(7))]
+
+
+def test_cursor_breaks_created_at_ties_by_id():
+    insert_notes(5, created_at=datetime(2026, 1, 1))
+
+    assert sum(walk_pages(2), []) == [f"note-{i:02d}" for i in reversed(range(5))]
+
+
+def test_full_last_page_has_no_next_cursor():
+    insert_notes(4)
+
+    assert [len(ids) for ids in walk_pages(2)] == [2, 2]
+
+
+def test_page_flattens_sales_totals():
+    rows = [
+        {"id": "sold", "created_at": datetime(2026, 1, 2), "totals": {"revenue": 64.0, "sales": 2}, "recent_sales": [{"payment_id": "p"}]},
+        {"id": "unsold", "created_at": datetime(2026, 1, 1)},
+    ]
+
+    page = server.dashboard_page(rows, 1, 12.5)
+    assert page["earnings"] == 12.5
+    assert page["notes"] == [{"id": "sold", "created_at": datetime(2026, 1, 2), "revenue": 64.0, "sales": 2, "recent_sales": [{"payment_id": "p"}]}]
+    assert server.decode_cursor(page["next_cursor"]) == (datetime(2026, 1, 2), "sold")
+
+    page = server.dashboard_page(rows[1:], 1, 0.0)
+    assert page["notes"][0] == {"id": "unsold", "created_at": datetime(2026, 1, 1), "revenue": 0.0, "sales": 0, "recent_sales": []}
+    assert page["next_cursor"] is None
+
+
+def test_projection_unwraps_lookup_facets(db):
+    # Rows shaped like the $lookup output, which mongomock cannot produce itself
+    db.rows.insert_many([
+        {"id": "sold", "sales": [{"totals": [{"_id": None, "revenue": 64.0, "sales": 2}], "recent": [{"payment_id": "p", "amount": 32.0}]}]},
+        {"id": "unsold", "sales": [{"totals": [], "recent": []}]},
+    ])
+
+    rows = {row["id"]: row for row in db.rows.aggregate([{"$project": server.DASHBOARD_ROW_PROJECTION}])}
+    assert rows["sold"]["totals"] == {"_id": None, "revenue": 64.0, "sales": 2}
+    assert rows["sold"]["recent_sales"] == [{"payment_id": "p", "amount": 32.0}]
+    assert server.dashboard_page([rows["unsold"]], 1, 0.0)["notes"][0]["sales"] == 0
+
+
+def test_invalid_cursor_is_rejected(client, make_user):
+    headers = make_user(SELLER)
+
+    response = client.get("/api/seller-dashboard", params={"cursor": "not-a-cursor"}, headers=headers)
+    assert response.status_code == 400
+
+
+@pytest.mark.skipif(not os.environ.get("MONGO_TEST_URL"), reason="needs a real mongod in MONGO_TEST_URL")
+def test_pipeline_against_mongod(monkeypatch):
+    client = MongoClient(os.environ["MONGO_TEST_URL"])
+    database = client[f"dashboard_test_{uuid.uuid4().hex}"]
+    try:
+        for name in ("notes_collection", "payments_collection", "notes_archive_collection"):
+            monkeypatch.setattr(server, name, database[getattr(server, name).name])
+        insert_notes(3)
+        server.notes_archive_collection.insert_one({"id": "archived", "uploader_email": SELLER, "is_deleted": True, "created_at": datetime(2025, 1, 1)})
+        server.payments_collection.insert_many([
+            {"id": "p1", "note_id": "note-02", "status": "completed", "seller_amount": 30.0, "created_at": datetime(2026, 2, 1)},
+            {"id": "p2", "note_id": "note-02", "status": "completed", "seller_amount": 34.0, "created_at": datetime(2026, 2, 2)},
+            {"id": "p3", "note_id": "note-02", "status": "pending", "seller_amount": 99.0, "created_at": datetime(2026, 2, 3)},
+            {"id": "p4", "note_id": "archived", "status": "completed", "seller_amount": 10.0, "created_at": datetime(2025, 2, 1)},
+        ])
+
+        seen, cursor = [], None
+        while True:
+            rows = list(server.notes_collection.aggregate(server.seller_dashboard_pipeline(SELLER, 2, cursor, True)))
+            page = server.dashboard_page(rows, 2, 0.0)
+            seen += page["notes"]
+            cursor = page["next_cursor"]
+            if cursor is None:
+                break
+
+        assert [note["id"] for note in seen] == ["note-02", "note-01", "note-00", "archived"]
+        assert (seen[0]["revenue"], seen[0]["sales"]) == (64.0, 2)
+        assert [sale["payment_id"] for sale in seen[0]["recent_sales"]] == ["p2", "p1"]
+        assert (seen[1]["revenue"], seen[1]["sales"], seen[1]["recent_sales"]) == (0.0, 0, [])
+        assert seen[3]["revenue"] == 10.0
+    finally:
+        client.drop_database(database.name)
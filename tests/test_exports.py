@@ -0,0 +1,29 @@
+import json
+from datetime import datetime
+
+import server
+
+
+def export_ids(client, headers, **params):
+    response = client.get("/api/export/sales", headers=headers, params={"format": "ndjson", **params})
+    assert response.status_code == 200
+    return [json.loads(line)["id"] for line in response.text.splitlines()]
+
+
+def test_sales_export_mixes_aware_and_naive_bounds(client, make_user):
+    headers = make_user("seller@example.com")
+    server.payments_collection.insert_many([
+        {"id": "december", "seller_email": "seller@example.com", "note_id": "n", "created_at": datetime(2023, 12, 31, 23, 30)},
+        {"id": "january", "seller_email": "seller@example.com", "note_id": "n", "created_at": datetime(2024, 1, 15)},
+        {"id": "february", "seller_email": "seller@example.com", "note_id": "n", "created_at": datetime(2024, 2, 1)},
+    ])
+
+    assert export_ids(client, headers, start="2024-01-01T00:00:00Z", end="2024-02-01T00:00:00") == ["january"]
+    # 00:00 in UTC+01:00 is 23:00 UTC the day before
+    assert export_ids(client, headers, start="2024-01-01T00:00:00+01:00", end="2024-02-01T00:00:00Z") == ["december", "january"]
+
+
+def test_export_rejects_reversed_range(client, make_user):
+    headers = make_user("seller@example.com")
+    response = client.get("/api/export/sales", headers=headers, params={"start": "2024-02-01T00:00:00Z", "end": "2024-01-01T00:00:00"})
+    assert response.status_code == 400
@@ -0,0 +1,40 @@
+import asyncio
+import os
+
+import pytest
+
+import server
+
+
+@pytest.fixture(autouse=True)
+def worker_pool():
+    yield
+    if server.note_worker_pool is not None:
+        server.note_worker_pool.shutdown(wait=True, cancel_futures=True)
+        server.note_worker_pool = None
+
+
+def break_pool():
+    pool = server.get_note_worker_pool()
+    with pytest.raises(server.BrokenProcessPool):
+        pool.submit(os._exit, 1).result()
+    return pool
+
+
+def test_map_recovers_from_a_dead_worker():
+    broken = break_pool()
+    assert server.map_in_note_workers(abs, [-1, -2, 3]) == [1, 2, 3]
+    assert server.note_worker_pool is not broken
+
+
+def test_run_recovers_from_a_dead_worker():
+    broken = break_pool()
+    assert asyncio.run(server.run_in_note_worker(abs, -4)) == 4
+    assert server.note_worker_pool is not broken
+
+
+def test_items_that_keep_killing_workers_come_back_failed():
+    results = server.map_in_note_workers(os._exit, [1])
+    assert isinstance(results[0], server.BrokenProcessPool)
+    # The pool that died is gone; later work runs on a fresh one
+    assert server.map_in_note_workers(abs, [-5]) == [5]
@@ -0,0 +1,51 @@
+import io
+
+import PyPDF2
+import pytest
+
+import server
+
+
+def make_pdf(pages):
+    writer = PyPDF2.PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(200, 200)
+    buffer = io.BytesIO()
+    writer.write(buffer)
+    buffer.seek(0)
+    return buffer
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    storage = server.LocalStorage(str(tmp_path / "uploads"))
+    monkeypatch.setattr(server, "file_storage", storage)
+    return storage
+
+
+@pytest.mark.parametrize("pages, preview_pages", [(2, 1), (3, 2), (10, server.PREVIEW_PAGES)])
+def test_preview_is_shorter_than_the_note(storage, pages, preview_pages):
+    storage.save("abc_notes.pdf", make_pdf(pages))
+    server.notes_collection.insert_one({"id": "note", "filename": "abc_notes.pdf", "preview_status": "pending"})
+
+    server.generate_preview("note", "abc_notes.pdf", "abc")
+
+    note = server.notes_collection.find_one({"id": "note"})
+    assert note["preview_status"] == "ready"
+    assert note["preview_pages"] == preview_pages
+    with storage.open(server.preview_key(note["preview_filename"])) as preview:
+        assert len(PyPDF2.PdfReader(preview).pages) == preview_pages
+
+
+def test_single_page_note_gets_no_preview(storage, client):
+    storage.save("abc_notes.pdf", make_pdf(1))
+    server.notes_collection.insert_one({"id": "note", "filename": "abc_notes.pdf", "preview_status": "pending"})
+
+    server.generate_preview("note", "abc_notes.pdf", "abc")
+
+    note = server.notes_collection.find_one({"id": "note"})
+    assert note["preview_status"] == "unavailable"
+    assert "preview_filename" not in note
+    assert "preview_excerpt" not in note
+    assert not storage.exists(server.preview_key("abc_preview.pdf"))
+    assert client.get("/api/note/note/preview").status_code == 404
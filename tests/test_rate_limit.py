@@ -0,0 +1,24 @@
+from starlette.requests import Request
+
+import server
+
+
+def request(peer, forwarded=None):
+    headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded else []
+    return Request({"type": "http", "client": (peer, 1234), "headers": headers})
+
+
+def test_untrusted_peers_cannot_pick_their_key():
+    assert server.client_ip(request("10.1.2.3", "6.6.6.6")) == "10.1.2.3"
+    assert server.client_ip(request("8.8.8.8", "6.6.6.6")) == "8.8.8.8"
+
+
+def test_forwarded_address_from_trusted_proxy():
+    assert server.client_ip(request("127.0.0.1", "1.2.3.4")) == "1.2.3.4"
+    assert server.client_ip(request("127.0.0.1")) == "127.0.0.1"
+
+
+def test_rightmost_untrusted_hop_is_used(monkeypatch):
+    monkeypatch.setattr(server, "TRUSTED_PROXIES", server.TRUSTED_PROXIES + [server.ipaddress.ip_network("10.0.0.0/8")])
+    # The client can prepend anything, but not the hop our ingress appended
+    assert server.client_ip(request("10.1.2.3", "6.6.6.6, 1.2.3.4, 10.0.0.5")) == "1.2.3.4"
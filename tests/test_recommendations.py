@@ -0,0 +1,40 @@
+import random
+
+import pytest
+
+import server
+
+
+def neighbor_scores(index, note_id):
+    return {other: score for other, score in index.neighbors.get(note_id, [])}
+
+
+def test_incremental_purchases_match_rebuild():
+    rng = random.Random(1)
+    notes = [f"note-{i}" for i in range(15)]
+    owned = {f"buyer-{i}@example.com": [] for i in range(12)}
+    incremental = server.CoPurchaseIndex()
+    for _ in range(60):
+        buyer, note_id = rng.choice(list(owned)), rng.choice(notes)
+        if note_id in owned[buyer]:
+            continue
+        incremental.record_purchase(buyer, [note_id], owned[buyer])
+        owned[buyer].append(note_id)
+
+    rebuilt = server.CoPurchaseIndex()
+    rebuilt.rebuild(list(owned.values()))
+
+    for note_id in notes:
+        expected = neighbor_scores(rebuilt, note_id)
+        actual = neighbor_scores(incremental, note_id)
+        assert actual.keys() == expected.keys()
+        for other, score in expected.items():
+            assert actual[other] == pytest.approx(score)
+
+
+def test_recommendations_skip_owned_notes():
+    index = server.CoPurchaseIndex()
+    index.rebuild([["a", "b"], ["a", "b", "c"], ["a", "c"], ["b", "d"]])
+    # c shares 2 of its 2 buyers with a, b only 2 of its 3, and d was never bought alongside a
+    ranked = index.for_user("buyer@example.com", ["a"])
+    assert [note_id for note_id, _ in ranked] == ["c", "b"]
@@ -0,0 +1,169 @@
+import gzip
+import io
+import os
+
+import boto3
+import pytest
+from moto import mock_aws
+
+import server
+
+
+@pytest.fixture
+def local_storage(tmp_path):
+    return server.LocalStorage(str(tmp_path / "uploads"))
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "eu-north-1")
+    with mock_aws():
+        boto3.client("s3").create_bucket(Bucket="notes", CreateBucketConfiguration={"LocationConstraint": "eu-north-1"})
+        yield
+
+
+@pytest.fixture
+def s3_storage(s3, tmp_path):
+    return server.S3Storage("notes", "notes/", None, str(tmp_path / "cache"))
+
+
+@pytest.fixture
+def small_cache(s3, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "S3_CACHE_PIN_SECONDS", 0)
+    return server.S3Storage("notes", "notes/", None, str(tmp_path / "cache"), cache_max_bytes=25)
+
+
+def test_local_storage_round_trip(local_storage):
+    local_storage.save("previews/abc_preview.pdf", io.BytesIO(b"%PDF-1.4 preview"))
+    assert local_storage.exists("previews/abc_preview.pdf")
+    with local_storage.open("previews/abc_preview.pdf") as file:
+        assert file.read() == b"%PDF-1.4 preview"
+    local_storage.delete("previews/abc_preview.pdf")
+    assert not local_storage.exists("previews/abc_preview.pdf")
+
+
+@pytest.mark.parametrize("key", ["abc_../../../escaped.pdf", "../escaped.pdf", "/etc/passwd"])
+def test_local_storage_refuses_keys_outside_root(local_storage, tmp_path, key):
+    with pytest.raises(ValueError):
+        local_storage.save(key, io.BytesIO(b"%PDF-1.4"))
+    assert not (tmp_path / "escaped.pdf").exists()
+
+
+@pytest.mark.parametrize("name, expected", [
+    ("notes.pdf", "notes.pdf"),
+    ("../../../x.pdf", "x.pdf"),
+    ("..\\..\\x.pdf", "x.pdf"),
+    ("..", None),
+    ("dir/", None),
+    ("", None),
+    (None, None),
+])
+def test_upload_filename(name, expected):
+    assert server.upload_filename(name) == expected
+
+
+def test_s3_storage_round_trip(s3_storage, tmp_path):
+    s3_storage.save("abc_notes.pdf", io.BytesIO(b"%PDF-1.4 notes"))
+    assert s3_storage.location("abc_notes.pdf") == "s3://notes/notes/abc_notes.pdf"
+    assert s3_storage.exists("abc_notes.pdf")
+    assert not s3_storage.exists("missing.pdf")
+    body = s3_storage.s3.get_object(Bucket="notes", Key="notes/abc_notes.pdf")["Body"].read()
+    assert body == b"%PDF-1.4 notes"
+
+
+def test_s3_storage_fetches_cache_misses(s3_storage):
+    s3_storage.s3.put_object(Bucket="notes", Key="notes/remote.pdf", Body=b"%PDF-1.4 remote")
+    with s3_storage.open("remote.pdf") as file:
+        assert file.read() == b"%PDF-1.4 remote"
+    # Served from the cache once fetched
+    s3_storage.s3.delete_object(Bucket="notes", Key="notes/remote.pdf")
+    with open(s3_storage.local_path("remote.pdf"), "rb") as file:
+        assert file.read() == b"%PDF-1.4 remote"
+
+
+def test_s3_storage_delete(s3_storage):
+    s3_storage.save("abc_notes.pdf", io.BytesIO(b"%PDF-1.4 notes"))
+    s3_storage.delete("abc_notes.pdf")
+    assert not s3_storage.exists("abc_notes.pdf")
+    with pytest.raises(Exception):
+        s3_storage.local_path("abc_notes.pdf")
+
+
+def test_s3_storage_download_redirects_to_presigned_url(s3_storage):
+    s3_storage.save("abc_notes.pdf", io.BytesIO(b"%PDF-1.4 notes"))
+    response = s3_storage.download_response("abc_notes.pdf", "notes.pdf")
+    assert response.status_code == 307
+    assert "notes/abc_notes.pdf" in response.headers["location"]
+    assert "X-Amz-Signature" in response.headers["location"]
+
+
+def test_s3_storage_refuses_cache_paths_outside_cache_dir(s3_storage):
+    with pytest.raises(ValueError):
+        s3_storage.save("abc_../../../escaped.pdf", io.BytesIO(b"%PDF-1.4"))
+
+
+def test_download_names_outside_latin1(local_storage):
+    local_storage.save("abc_Łódź.pdf", io.BytesIO(b"%PDF-1.4"))
+    response = local_storage.download_response("abc_Łódź.pdf", "Łódź.pdf")
+    assert response.headers["content-disposition"] == "attachment; filename*=utf-8''%C5%81%C3%B3d%C5%BA.pdf"
+    assert server.content_disposition("notes.pdf") == 'attachment; filename="notes.pdf"'
+
+
+def test_cold_download_with_non_latin1_name(client, make_user, tmp_path, monkeypatch):
+    cold = server.LocalStorage(str(tmp_path / "cold"))
+    monkeypatch.setattr(server, "cold_storage", cold)
+    cold.save("abc_Łódź.pdf.gz", io.BytesIO(gzip.compress(b"%PDF-1.4 cold")))
+    server.notes_archive_collection.insert_one({
+        "id": "archived", "uploader_email": "seller@example.com", "price": 10.0, "is_deleted": True,
+        "filename": "abc_Łódź.pdf", "file_path": None, "cold_key": "abc_Łódź.pdf.gz"
+    })
+    headers = make_user("buyer@example.com", purchased_notes=["archived"])
+
+    response = client.get("/api/note/archived/download", headers=headers)
+    assert response.status_code == 200
+    assert response.content == b"%PDF-1.4 cold"
+    assert "filename*=utf-8''" in response.headers["content-disposition"]
+
+
+def cached_keys(storage):
+    return sorted(key for key in storage.cache_entries if os.path.exists(os.path.join(storage.cache_dir, key)))
+
+
+def test_s3_cache_evicts_least_recently_used_on_save_and_fetch(small_cache):
+    for key in ("a.pdf", "b.pdf"):
+        small_cache.save(key, io.BytesIO(b"x" * 10))
+    small_cache.local_path("a.pdf")  # a is now the most recently used
+    small_cache.save("c.pdf", io.BytesIO(b"x" * 10))
+    assert cached_keys(small_cache) == ["a.pdf", "c.pdf"]
+    assert small_cache.cache_bytes == 20
+
+    small_cache.local_path("b.pdf")  # Fetched again from the bucket
+    assert cached_keys(small_cache) == ["b.pdf", "c.pdf"]
+
+
+def test_s3_cache_keeps_files_being_read(small_cache):
+    small_cache.save("a.pdf", io.BytesIO(b"x" * 10))
+    with small_cache.open("a.pdf") as reading:
+        small_cache.save("b.pdf", io.BytesIO(b"x" * 10))
+        small_cache.save("c.pdf", io.BytesIO(b"x" * 10))
+        assert "a.pdf" in cached_keys(small_cache)
+        assert reading.read() == b"x" * 10
+    assert small_cache.readers == {}
+
+
+def test_s3_cache_keeps_recently_handed_out_paths(s3, tmp_path):
+    storage = server.S3Storage("notes", "notes/", None, str(tmp_path / "cache"), cache_max_bytes=15)
+    storage.save("a.pdf", io.BytesIO(b"x" * 10))
+    path = storage.local_path("a.pdf")
+    storage.save("b.pdf", io.BytesIO(b"x" * 10))
+    # Over budget, but a caller may be about to open path
+    assert os.path.exists(path)
+
+
+def test_s3_cache_adopts_files_from_an_earlier_run(s3_storage, tmp_path):
+    s3_storage.save("a.pdf", io.BytesIO(b"x" * 10))
+    restarted = server.S3Storage("notes", "notes/", None, str(tmp_path / "cache"))
+    assert restarted.cache_bytes == 10
+    assert list(restarted.cache_entries) == ["a.pdf"]
@@ -0,0 +1,71 @@
+import pytest
+
+import server
+
+TEXT = "binary search trees keep their keys ordered so lookups take logarithmic time"
+
+
+def make_notes():
+    notes = [
+        {"id": "a", "title": "Search trees", "description": ""},
+        {"id": "b", "title": "Search trees", "description": ""},
+        {"id": "c", "title": "Thermodynamics", "description": ""},
+    ]
+    bodies = {
+        "a": server.note_body_terms(TEXT, ""),
+        "b": server.note_body_terms(TEXT, ""),
+        "c": server.note_body_terms("entropy of an ideal gas rises during free expansion", ""),
+    }
+    return notes, bodies
+
+
+def test_load_matches_rebuild():
+    notes, bodies = make_notes()
+    index = server.TextIndex()
+    index.load(notes, bodies)
+    loaded = index.similar("a", 2)
+
+    assert loaded[0][0] == "b"
+    assert loaded[0][1] == pytest.approx(1.0, abs=1e-5)
+
+    index.rebuild()
+    rebuilt = index.similar("a", 2)
+    assert [note_id for note_id, _ in rebuilt] == [note_id for note_id, _ in loaded]
+    assert [score for _, score in rebuilt] == pytest.approx([score for _, score in loaded])
+
+
+def test_added_notes_are_found():
+    notes, bodies = make_notes()
+    index = server.TextIndex()
+    for note in notes:
+        index.set_body(note["id"], bodies[note["id"]])
+        index.add(note)
+    assert [note_id for note_id, _ in index.similar("a", 2)] == ["b"]
+
+    index.remove("b")
+    assert all(note_id != "b" for note_id, _ in index.similar("a", 2))
+
+
+def test_rebuild_keeps_rows_changed_meanwhile(monkeypatch):
+    notes, bodies = make_notes()
+    index = server.TextIndex()
+    index.load(notes, bodies)
+    weigh = server.TextIndex._weigh
+    changed = {}
+
+    # A note is removed and another re-indexed while the rebuild weighs its snapshot
+    def weigh_during_changes(terms, doc_freq, doc_count):
+        if not changed:
+            changed["b"] = None  # add() weighs too, so only change things once
+            index.remove("c")
+            index.add({"id": "b", "title": "Thermodynamics entropy", "description": ""})
+            changed["b"] = index.matrix[index.rows["b"]].copy()
+        return weigh(terms, doc_freq, doc_count)
+
+    monkeypatch.setattr(server.TextIndex, "_weigh", staticmethod(weigh_during_changes))
+    index.rebuild()
+
+    assert "c" not in index.rows
+    free = [row for row, note_id in enumerate(index.row_ids) if note_id is None]
+    assert not index.matrix[free].any()
+    assert (index.matrix[index.rows["b"]] == changed["b"]).all()
@@ -0,0 +1,197 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def provider(monkeypatch):
+    provider = server.LocalPayoutProvider()
+    monkeypatch.setattr(server, "payout_provider", provider)
+    monkeypatch.setattr(server.time, "sleep", lambda seconds: None)
+    return provider
+
+
+def profile(client, headers):
+    response = client.get("/api/profile", headers=headers)
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_withdraw_settle_profile_balances(client, make_user, provider):
+    headers = make_user("seller@example.com", earnings=500.0)
+
+    response = client.post("/api/withdraw", headers=headers, json={"amount": 200.0, "payment_method": "swish"})
+    assert response.status_code == 200
+    assert response.json()["status"] == "pending"
+
+    balances = profile(client, headers)
+    assert balances["pending_withdrawal"] == 200.0
+    assert balances["withdrawn"] == 0.0
+    assert balances["available_balance"] == 300.0
+
+    assert server.settle_withdrawals() == 1
+
+    balances = profile(client, headers)
+    assert balances["pending_withdrawal"] == 0.0
+    assert balances["withdrawn"] == 200.0
+    assert balances["available_balance"] == 300.0
+    withdrawal = server.withdrawals_collection.find_one({"id": response.json()["withdrawal_id"]})
+    assert withdrawal["status"] == "completed"
+    assert withdrawal["payout_id"] == provider.payouts[withdrawal["id"]]
+
+
+def test_withdraw_rejects_amounts_over_available_balance(client, make_user):
+    headers = make_user("seller@example.com", earnings=300.0)
+
+    assert client.post("/api/withdraw", headers=headers, json={"amount": 200.0}).status_code == 200
+    # Only 100 left once the first withdrawal is reserved
+    response = client.post("/api/withdraw", headers=headers, json={"amount": 150.0})
+    assert response.status_code == 400
+
+    assert server.withdrawals_collection.count_documents({}) == 1
+    assert profile(client, headers)["pending_withdrawal"] == 200.0
+
+
+def test_withdraw_below_minimum(client, make_user):
+    headers = make_user("seller@example.com", earnings=500.0)
+    response = client.post("/api/withdraw", headers=headers, json={"amount": 100.0})
+    assert response.status_code == 400
+    assert profile(client, headers)["pending_withdrawal"] == 0.0
+
+
+def test_failed_insert_releases_reservation(client, make_user, monkeypatch):
+    headers = make_user("seller@example.com", earnings=500.0)
+
+    def fail(*args, **kwargs):
+        raise server.pymongo.errors.AutoReconnect("connection lost")
+
+    monkeypatch.setattr(server.withdrawals_collection, "insert_one", fail)
+    with pytest.raises(server.pymongo.errors.AutoReconnect):
+        client.post("/api/withdraw", headers=headers, json={"amount": 200.0})
+    assert profile(client, headers)["pending_withdrawal"] == 0.0
+
+
+def test_settlement_retries_then_gives_up(client, make_user, provider):
+    headers = make_user("seller@example.com", earnings=500.0)
+    withdrawal_id = client.post("/api/withdraw", headers=headers, json={"amount": 200.0}).json()["withdrawal_id"]
+    provider.failure_rate = 1.0
+
+    for attempt in range(1, server.SETTLEMENT_MAX_ATTEMPTS):
+        assert server.settle_withdrawals() == 0
+        withdrawal = server.withdrawals_collection.find_one({"id": withdrawal_id})
+        assert withdrawal["status"] == "pending"
+        assert withdrawal["attempts"] == attempt
+        assert profile(client, headers)["pending_withdrawal"] == 200.0
+
+    assert server.settle_withdrawals() == 0
+    assert server.withdrawals_collection.find_one({"id": withdrawal_id})["status"] == "failed"
+    balances = profile(client, headers)
+    assert balances["pending_withdrawal"] == 0.0
+    assert balances["withdrawn"] == 0.0
+    assert balances["available_balance"] == 500.0
+
+
+def test_settlement_recovers_after_transient_failure(client, make_user, provider):
+    headers = make_user("seller@example.com", earnings=500.0)
+    client.post("/api/withdraw", headers=headers, json={"amount": 200.0})
+
+    provider.failure_rate = 1.0
+    assert server.settle_withdrawals() == 0
+    provider.failure_rate = 0.0
+    assert server.settle_withdrawals() == 1
+    assert profile(client, headers)["withdrawn"] == 200.0
+
+
+def test_stale_claims_are_requeued_and_paid_once(client, make_user, provider):
+    headers = make_user("seller@example.com", earnings=500.0)
+    withdrawal_id = client.post("/api/withdraw", headers=headers, json={"amount": 200.0}).json()["withdrawal_id"]
+    # A worker claimed the withdrawal, paid it out and crashed before recording the result
+    provider.send_batch([{"idempotency_key": withdrawal_id}])
+    server.withdrawals_collection.update_one(
+        {"id": withdrawal_id},
+        {"$set": {"status": "processing", "batch_id": "crashed", "claimed_at": datetime.utcnow() - server.SETTLEMENT_CLAIM_TIMEOUT - timedelta(minutes=1)}}
+    )
+
+    assert server.settle_withdrawals() == 1
+    assert len(provider.payouts) == 1
+    assert server.withdrawals_collection.find_one({"id": withdrawal_id})["payout_id"] == provider.payouts[withdrawal_id]
+    assert profile(client, headers)["withdrawn"] == 200.0
+
+
+def test_recent_claims_are_left_alone(make_user, provider):
+    make_user("seller@example.com", earnings=500.0, pending_withdrawal=200.0)
+    server.withdrawals_collection.insert_one({
+        "id": "in-flight", "user_email": "seller@example.com", "amount": 200.0, "payment_method": "generic",
+        "status": "processing", "batch_id": "other-worker", "claimed_at": datetime.utcnow(), "attempts": 0,
+        "created_at": datetime.utcnow(), "processed_at": None
+    })
+    assert server.settle_withdrawals() == 0
+    assert server.withdrawals_collection.find_one({"id": "in-flight"})["status"] == "processing"
+
+
+def test_migration_backfills_balances(db):
+    server.users_collection.insert_many([
+        {"email": "old@example.com", "earnings": 1000.0},
+        {"email": "new@example.com", "earnings": 500.0, "withdrawn": 50.0, "pending_withdrawal": 25.0},
+    ])
+    server.withdrawals_collection.insert_many([
+        {"id": "1", "user_email": "old@example.com", "amount": 200.0, "status": "completed"},
+        {"id": "2", "user_email": "old@example.com", "amount": 150.0, "status": "pending"},
+        {"id": "3", "user_email": "old@example.com", "amount": 175.0, "status": "processing"},
+        {"id": "4", "user_email": "old@example.com", "amount": 300.0, "status": "failed"},
+        {"id": "5", "user_email": "new@example.com", "amount": 999.0, "status": "completed"},
+    ])
+
+    server.migrate_withdrawal_balances()
+    server.migrate_withdrawal_balances()  # Running again must not double count
+
+    old = server.users_collection.find_one({"email": "old@example.com"})
+    assert old["withdrawn"] == 200.0
+    assert old["pending_withdrawal"] == 325.0
+    # Users that already carry balances are not touched
+    new = server.users_collection.find_one({"email": "new@example.com"})
+    assert new["withdrawn"] == 50.0
+    assert new["pending_withdrawal"] == 25.0
+
+
+def test_slow_batch_settled_elsewhere_is_credited_once(client, make_user, provider, monkeypatch):
+    headers = make_user("seller@example.com", earnings=500.0)
+    client.post("/api/withdraw", headers=headers, json={"amount": 200.0})
+    send_payouts = server.send_payouts
+
+    # While this worker waits on the provider its claim goes stale, and another worker settles the batch
+    def slow_send_payouts(withdrawals):
+        server.withdrawals_collection.update_many({}, {"$set": {"claimed_at": datetime.utcnow() - server.SETTLEMENT_CLAIM_TIMEOUT - timedelta(minutes=1)}})
+        monkeypatch.setattr(server, "send_payouts", send_payouts)
+        assert server.settle_withdrawals() == 1
+        return send_payouts(withdrawals)
+
+    monkeypatch.setattr(server, "send_payouts", slow_send_payouts)
+    assert server.settle_withdrawals() == 0
+
+    balances = profile(client, headers)
+    assert balances["withdrawn"] == 200.0
+    assert balances["pending_withdrawal"] == 0.0
+
+
+def test_give_up_leaves_withdrawals_completed_elsewhere(client, make_user, provider, monkeypatch):
+    headers = make_user("seller@example.com", earnings=500.0)
+    withdrawal_id = client.post("/api/withdraw", headers=headers, json={"amount": 200.0}).json()["withdrawal_id"]
+    server.withdrawals_collection.update_one({"id": withdrawal_id}, {"$set": {"attempts": server.SETTLEMENT_MAX_ATTEMPTS - 1}})
+    send_payouts = server.send_payouts
+
+    def settled_elsewhere_then_fail(withdrawals):
+        server.withdrawals_collection.update_many({}, {"$set": {"claimed_at": datetime.utcnow() - server.SETTLEMENT_CLAIM_TIMEOUT - timedelta(minutes=1)}})
+        monkeypatch.setattr(server, "send_payouts", send_payouts)
+        assert server.settle_withdrawals() == 1
+        raise server.PayoutError("timeout")
+
+    monkeypatch.setattr(server, "send_payouts", settled_elsewhere_then_fail)
+    assert server.settle_withdrawals() == 0
+
+    assert server.withdrawals_collection.find_one({"id": withdrawal_id})["status"] == "completed"
+    balances = profile(client, headers)
+    assert balances["withdrawn"] == 200.0
+    assert balances["pending_withdrawal"] == 0.0